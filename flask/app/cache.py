@@ -0,0 +1,137 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Cache of the Elasticsearch results behind the table, so repeated sorts and searches don't query
+Elasticsearch again
+Results are kept for CACHE_TTL seconds, and the least recently used are dropped once there are
+CACHE_SIZE of them. Every index has a generation which is part of the key of its results, so
+labelling or reprocessing an index invalidates its results by bumping the generation. Results for
+a pattern (appcompat-*) are invalidated by a change to any index.
+
+The local store is per process, and shared by the threads serving requests. Use the Redis store when the app runs in several processes, so
+they share the results, the generations and the counters (set maxmemory-policy allkeys-lru to
+keep the cache bounded).
+'''
+
+CACHE_PREFIX = 'cache:'
+CACHE_TTL = 60
+CACHE_SIZE = 256
+# generation bumped by a change to any index, for the results of patterns
+ANY_INDEX = '_any'
+# generation bumped when a pattern is changed, for the results of every index
+ALL_INDICES = '_all'
+
+def is_pattern(index_name):
+    return '*' in index_name or ',' in index_name
+
+class LocalStore(object):
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        # {key: (expires, value)}, least recently used first
+        self.values = OrderedDict()
+        self.generation_values = {}
+        self.counters = {'hits': 0, 'misses': 0}
+        # the app serves requests in threads
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.values:
+                return None
+            expires, value = self.values.pop(key)
+            if expires < time.time():
+                return None
+            self.values[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = (time.time() + ttl, value)
+            while len(self.values) > self.size:
+                self.values.popitem(last=False)
+
+    def generations(self, names):
+        with self.lock:
+            return [self.generation_values.get(i, 0) for i in names]
+
+    def bump(self, names):
+        with self.lock:
+            for i in names:
+                self.generation_values[i] = self.generation_values.get(i, 0) + 1
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, size=len(self.values))
+
+class RedisStore(object):
+    def __init__(self, redis_conn):
+        self.redis = redis_conn
+
+    def get(self, key):
+        value = self.redis.get(CACHE_PREFIX + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.redis.setex(CACHE_PREFIX + key, ttl, json.dumps(value))
+
+    def generations(self, names):
+        return [int(i or 0) for i in self.redis.hmget(CACHE_PREFIX + 'generations', names)]
+
+    def bump(self, names):
+        pipe = self.redis.pipeline()
+        for i in names:
+            pipe.hincrby(CACHE_PREFIX + 'generations', i, 1)
+        pipe.execute()
+
+    def count(self, counter):
+        self.redis.hincrby(CACHE_PREFIX + 'stats', counter, 1)
+
+    def stats(self):
+        stats = dict((field, int(value)) for field, value in self.redis.hgetall(CACHE_PREFIX + 'stats').items())
+        return dict({'hits': 0, 'misses': 0}, **stats)
+
+class ResponseCache(object):
+    def __init__(self, store, ttl=CACHE_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    def key(self, index_name, params):
+        if is_pattern(index_name):
+            names = [ANY_INDEX, ALL_INDICES]
+        else:
+            names = [index_name, ALL_INDICES]
+        key = json.dumps([index_name, self.store.generations(names), params], sort_keys=True)
+        return hashlib.sha1(key).hexdigest()
+
+    '''
+    The cached result for params on an index, or the result of fetch which is then cached
+    '''
+    def get(self, index_name, params, fetch):
+        key = self.key(index_name, params)
+        value = self.store.get(key)
+        if value is not None:
+            self.store.count('hits')
+            return value
+
+        self.store.count('misses')
+        value = fetch()
+        self.store.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self, index_name):
+        if is_pattern(index_name):
+            self.store.bump([ALL_INDICES])
+        else:
+            self.store.bump([index_name, ANY_INDEX])
+
+    def stats(self):
+        return self.store.stats()
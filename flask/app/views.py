@@ -4,15 +4,23 @@ from flask import request
 from flask import g
 from flask import abort
 from app import app
+from app.cache import ResponseCache, LocalStore, RedisStore
 from elasticsearch import Elasticsearch
 from elasticsearch.client import IndicesClient
 from elasticsearch.exceptions import RequestError
 from rq import Queue
 from redis import Redis
+from datetime import datetime
+import json
+import time
 
 
 es = Elasticsearch()
 
+# 'redis' to share the result cache between the processes serving the app
+CACHE_BACKEND = 'local'
+cache = ResponseCache(RedisStore(Redis()) if CACHE_BACKEND == 'redis' else LocalStore())
+
 columns = [
     '_id',
     '_index',
@@ -44,12 +52,14 @@ columns = [
 ]
 
 def get_es_indices():
-    es_idx = IndicesClient(es)
-    indicies = es_idx.get('appcompat-*')
-    result = []
-    for index_name,v in indicies.iteritems():
-        result.append((index_name,index_name,v['settings']['index']['creation_date']))
-    return result
+    def fetch():
+        es_idx = IndicesClient(es)
+        indicies = es_idx.get('appcompat-*')
+        result = []
+        for index_name,v in indicies.iteritems():
+            result.append((index_name,index_name,v['settings']['index']['creation_date']))
+        return result
+    return cache.get('appcompat-*', 'indices', fetch)
 
 
 @app.route('/')
@@ -62,6 +72,50 @@ def index():
         dt_columns=columns,
         instances=instances)
 
+# only the fields the table shows are fetched
+source_columns = [i for i in columns if not i.startswith('_')]
+# missing longs sort as the biggest or smallest long
+MISSING_LONG = 2 ** 63 - 1
+
+# major version of the Elasticsearch cluster, search_after needs 5 or later
+es_version = None
+def get_es_version():
+    global es_version
+    if es_version is None:
+        es_version = int(es.info()['version']['number'].split('.')[0])
+    return es_version
+
+def is_missing(value):
+    if isinstance(value, (int, long, float)):
+        return abs(value) == float('inf') or abs(value) >= MISSING_LONG
+    return value is None
+
+'''
+A filter for the entries sorted after the sort values of an entry, i.e. search_after for
+Elasticsearch before 5. Entries missing the field sort last in either direction.
+The last sort field has to be unique, otherwise entries tied with the entry are skipped.
+'''
+def search_after_filter(sort, values):
+    field, direction = sort[0]
+    value = values[0]
+    rest = search_after_filter(sort[1:], values[1:]) if len(sort) > 1 else {'bool': {'must_not': [{'match_all': {}}]}}
+    missing = {'bool': {'must_not': [{'exists': {'field': field}}]}}
+
+    if is_missing(value):
+        return {'bool': {'filter': [missing, rest]}}
+
+    after = {'range': {field: {'gt' if direction == 'asc' else 'lt': value}}}
+    same = {'bool': {'filter': [{'term': {field: value}}, rest]}}
+    return {'bool': {'should': [after, same, missing], 'minimum_should_match': 1}}
+
+'''
+Pages of entries for the DataTable
+With cursor (the sort values of the last entry on the page before) the page is found with
+search_after rather than skipping start entries, so a page costs the same however deep it is.
+Without one (sorting on _id or _index, jumping to a page whose previous page hasn't been seen, or
+after labels or scores have changed) the page falls back to from/size, which costs more the
+deeper it is and fails past index.max_result_window (10000 entries by default).
+'''
 @app.route('/api/entries', methods=['GET'])
 @app.route('/api/entries/<string:index_name>', methods=['GET'])
 def entries(index_name='appcompat-*'):
@@ -71,6 +125,7 @@ def entries(index_name='appcompat-*'):
     sort_idx = request.args.get('order[0][column]', 0, type=int)
     sort_direction = request.args.get('order[0][dir]', 'asc', type=str)
     search = request.args.get('search[value]', '', type=str)
+    cursor = request.args.get('cursor', '', type=str)
 
     if sort_idx < 0 or sort_idx > len(columns):
         return abort(404)
@@ -79,30 +134,55 @@ def entries(index_name='appcompat-*'):
         return abort(404)
 
     sort_column = columns[sort_idx]
+    # the same host can be in two indices, so _uid makes every entry's sort values unique and
+    # an entry that ties with the cursor isn't skipped
+    sort = [(sort_column, sort_direction), ('hostname', 'asc'), ('run_order', 'asc'), ('_uid', 'asc')]
 
     if search:
-        try:
-            result = es.search(index=index_name, 
-                doc_type='appcompat', 
-                q=search, 
-                size=length, 
-                from_=start, 
-                sort='{}:{},hostname:asc,run_order:asc'.format(sort_column, sort_direction))
-        except RequestError as e:
-            return jsonify(e.info), 500
+        query = {'query_string': {'query': search}}
     else:
-        result = es.search(index=index_name, 
-            doc_type='appcompat', 
-            body={'query':{'match_all': {}}}, 
-            size=length, 
-            from_=start, 
-            sort='{}:{},hostname:asc,run_order:asc'.format(sort_column, sort_direction))
+        query = {'match_all': {}}
+
+    body = {
+        'query': query,
+        'sort': [{field: {'order': direction}} for field, direction in sort],
+        '_source': source_columns,
+    }
+
+    # entries before the cursor aren't counted when it's a filter
+    skipped = 0
+    if cursor and not sort_column.startswith('_'):
+        try:
+            cursor = json.loads(cursor)
+        except ValueError:
+            return abort(404)
+        if not isinstance(cursor, list) or len(cursor) != len(sort):
+            return abort(404)
+
+        if get_es_version() >= 5:
+            body['search_after'] = cursor
+        else:
+            body['query'] = {'bool': {'must': [query], 'filter': [search_after_filter(sort, cursor)]}}
+            skipped = start
+        start = 0
+
+    def fetch():
+        return es.search(index=index_name,
+            doc_type='appcompat',
+            body=body,
+            size=length,
+            from_=start)
+
+    try:
+        result = cache.get(index_name, {'body': body, 'size': length, 'from': start}, fetch)
+    except RequestError as e:
+        return jsonify(e.info), 500
 
     return jsonify({
             'data': result['hits']['hits'],
             'draw': draw,
-            'recordsTotal': result['hits']['total'],
-            'recordsFiltered': result['hits']['total'],
+            'recordsTotal': result['hits']['total'] + skipped,
+            'recordsFiltered': result['hits']['total'] + skipped,
         })
 
 
@@ -122,14 +202,109 @@ def label(index_name,entry_id):
         abort(405)
 
     if (index_name != 'appcompat-training'):
-        # update the entry in the index
-        es.update(index=index_name, doc_type='appcompat', id=entry_id, body={'doc':{'class_label':label}})
-    
+        # update the entry in the index, refreshed so the table isn't cached without the label
+        es.update(index=index_name, doc_type='appcompat', id=entry_id, body={'doc':{'class_label':label}}, refresh=True)
+
+    cache.invalidate(index_name)
+    cache.invalidate('appcompat-training')
+
+    # copy the change to the training data the workers train from
+    q = Queue(connection=Redis())
+    q.enqueue('predict_data.sync_training_entry', entry_id)
+
 
     return jsonify({
         'result': 'successful'
         })
 
+'''
+Label many entries at once, the body is JSON: {"labels": [{"index": ..., "id": ..., "label": ...}]}
+An empty label clears the label, like DELETE on /api/label. The entries to copy to the training
+index are fetched with one multi get, and all of the writes are one bulk request. Returns the
+result of each label in order.
+'''
+@app.route('/api/labels', methods=['POST'])
+def labels():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('labels'), list):
+        return abort(404)
+    items = body['labels']
+
+    results = []
+    for item in items:
+        if not isinstance(item, dict):
+            item = {}
+        result = {'index': item.get('index'), 'id': item.get('id'), 'label': item.get('label', '')}
+        # anything but a string can't go in the mget or bulk request
+        if not all(isinstance(result[i], basestring) and result[i] for i in ['index', 'id']):
+            result['error'] = 'index and id are required'
+        elif result['label'] not in ['', 'evil', 'not_evil', 'suspicious']:
+            result['error'] = 'unknown label'
+        results.append(result)
+    valid = [i for i in results if 'error' not in i]
+
+    # the entries copied to the training index, unless they are already there
+    copies = [i for i in valid if i['label'] and i['index'] != 'appcompat-training']
+    if copies:
+        docs = [{'_index': i['index'], '_type': 'appcompat', '_id': i['id']} for i in copies]
+        for result, doc in zip(copies, es.mget(body={'docs': docs})['docs']):
+            if doc.get('found'):
+                result['source'] = doc['_source']
+            else:
+                result['error'] = 'entry not found'
+        valid = [i for i in valid if 'error' not in i]
+
+    # the actions for each label, which are the ones labelling a single entry does
+    actions = []
+    for result in valid:
+        training = {'_index': 'appcompat-training', '_type': 'appcompat', '_id': result['id']}
+        source = {'_index': result['index'], '_type': 'appcompat', '_id': result['id']}
+        doc = {'doc': {'class_label': result['label']}}
+        result['actions'] = []
+        if not result['label']:
+            result['actions'].append(({'delete': training}, None))
+        elif 'source' in result:
+            upsert = dict(result.pop('source'), class_label=result['label'])
+            result['actions'].append(({'update': training}, dict(doc, upsert=upsert)))
+        else:
+            result['actions'].append(({'update': training}, doc))
+        if result['index'] != 'appcompat-training':
+            result['actions'].append(({'update': source}, doc))
+        actions.extend(result['actions'])
+
+    if actions:
+        body = []
+        for action, doc in actions:
+            body.append(action)
+            if doc is not None:
+                body.append(doc)
+        # refreshed so the table isn't cached without the labels
+        bulk_items = iter(es.bulk(body=body, refresh=True)['items'])
+        for result in valid:
+            for action, doc in result.pop('actions'):
+                (op_type, bulk_item), = next(bulk_items).items()
+                # clearing a label that was never stored is fine
+                if bulk_item.get('status', 500) >= 300 and not (op_type == 'delete' and bulk_item.get('status') == 404):
+                    result['error'] = bulk_item.get('error', 'failed')
+
+    # anything sent in the bulk request may have changed, even if some of its actions failed
+    for index_name in set(i['index'] for i in valid) | set(['appcompat-training']):
+        cache.invalidate(index_name)
+
+    # copy the changes to the training data the workers train from
+    if valid:
+        q = Queue(connection=Redis())
+        q.enqueue('predict_data.sync_training_entries', [i['id'] for i in valid])
+
+    for result in results:
+        result['result'] = 'failed' if 'error' in result else 'successful'
+
+    return jsonify({
+        'result': 'successful',
+        'errors': any('error' in i for i in results),
+        'labels': results,
+        })
+
 # remove the training entry
 def delete_training_entry(index_name, entry_id):
     result = es.get(index='appcompat-training', doc_type='appcompat', id=entry_id, ignore=404)
@@ -184,11 +359,23 @@ def reprocess(index_name=None):
     q = Queue(connection=redis_conn)
 
     full_scan = request.form.get('full_scan', '', type=str)
+    incremental = request.form.get('incremental', '', type=str)
+    # number of workers a full scan is split between, the default is predict_data's PREDICT_SLICES
+    slices = request.form.get('slices', None, type=int)
+    # scores that move by less than this aren't written back, the default is predict_data's PREDICT_EPSILON
+    epsilon = request.form.get('epsilon', None, type=float)
+    if epsilon is not None and not 0.0 <= epsilon < 1.0:
+        return abort(404)
 
     if not index_name:
         index_name = 'appcompat-*'
 
-    job = q.enqueue('predict_data.update_predict', index_name, full_scan == 'true', timeout=3600)
+    cache.invalidate(index_name)
+    kwargs = {'slices': slices}
+    if epsilon is not None:
+        kwargs['epsilon'] = epsilon
+    job = q.enqueue_call('predict_data.update_predict', args=(index_name, full_scan == 'true', incremental == 'true'),
+                         kwargs=kwargs, timeout=3600)
 
     return jsonify({'result': 'successful', 'job_id': job.id})
 
@@ -199,5 +386,118 @@ def job_status(job_id):
     q = Queue(connection=redis_conn)
 
     job = q.fetch_job(job_id)
+    job_status = job.get_status()
+    result = {'result': 'successful', 'job_status': job_status}
+
+    # a full scan reprocess has finished once the slice jobs it queued have
+    job_ids = job.meta.get('jobs')
+    if job_status == 'finished' and job_ids:
+        # finished jobs are removed after a while, failed jobs are kept
+        statuses = [i.get_status() if i else 'finished' for i in (q.fetch_job(i) for i in job_ids)]
+        if 'failed' in statuses:
+            job_status = 'failed'
+        elif statuses.count('finished') < len(statuses):
+            job_status = 'started'
+        result.update({'job_status': job_status, 'jobs': len(statuses), 'jobs_finished': statuses.count('finished')})
+
+    # the scores have changed since the reprocess was started
+    if job_status == 'finished' and job.func_name == 'predict_data.update_predict':
+        cache.invalidate(job.args[0])
+
+    return jsonify(result)
+
+
+@app.route('/api/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(dict(cache.stats(), result='successful', backend=CACHE_BACKEND))
+
+
+# same keys as the loader's metrics.py, metrics:<index>:<stage>
+METRICS_PREFIX = 'metrics:'
+METRICS_STAGES = ['read', 'queue', 'extract', 'load', 'predict']
+# an ingest that hasn't recorded anything for this long is no longer running
+METRICS_ACTIVE_SECONDS = 60
+
+def get_index_metrics(redis_conn, index_name):
+    now = time.time()
+    stages = {}
+    for stage in METRICS_STAGES:
+        values = redis_conn.hgetall('{}{}:{}'.format(METRICS_PREFIX, index_name, stage))
+        if not values:
+            continue
+        values = dict((field, float(value)) for field, value in values.items())
+
+        # throughput while the stage was working, and over the time since it started
+        values['rows_per_sec'] = values['rows'] / values['seconds'] if values['seconds'] else 0.0
+        elapsed = values['last'] - values['first']
+        values['wall_rows_per_sec'] = values['rows'] / elapsed if elapsed else 0.0
+        values['active'] = now - values['last'] < METRICS_ACTIVE_SECONDS
+        stages[stage] = values
+
+    rows = dict((stage, stages.get(stage, {}).get('rows', 0)) for stage in METRICS_STAGES)
+    return {
+        'index': index_name,
+        'active': any(i['active'] for i in stages.values()),
+        'stages': stages,
+        # rows waiting between the stages
+        'lag': {
+            'extract': max(0, rows['queue'] - rows['extract']),
+            'load': max(0, rows['extract'] - rows['load']),
+        }
+    }
+
+# how many jobs are waiting on each rq queue and how long the oldest has waited
+def get_queue_lag(redis_conn):
+    result = {}
+    for name in ['default', 'high']:
+        q = Queue(name, connection=redis_conn)
+        oldest = 0.0
+        job_ids = q.get_job_ids(0, 1)
+        if job_ids:
+            job = q.fetch_job(job_ids[0])
+            if job and job.enqueued_at:
+                oldest = (datetime.utcnow() - job.enqueued_at).total_seconds()
+        result[name] = {'jobs': q.count, 'oldest_seconds': oldest}
+    return result
+
+@app.route('/api/metrics', methods=['GET'])
+@app.route('/api/metrics/<string:index_name>', methods=['GET'])
+def metrics(index_name=None):
+    redis_conn = Redis()
+
+    if index_name:
+        indices = [index_name]
+    else:
+        indices = sorted(redis_conn.smembers(METRICS_PREFIX + 'indices'))
+
+    ingests = [get_index_metrics(redis_conn, i) for i in indices]
+    if not index_name and not request.args.get('all', '', type=str):
+        # only the running ingests unless asked for all of them
+        ingests = [i for i in ingests if i['active']]
+
+    return jsonify({
+        'result': 'successful',
+        'ingests': ingests,
+        'queues': get_queue_lag(redis_conn),
+        })
+
+
+# same key as the loader's progress.py
+PROGRESS_PREFIX = 'progress:'
+
+@app.route('/api/ingest_status/<string:index_name>', methods=['GET'])
+def ingest_status(index_name):
+    redis_conn = Redis()
+
+    progress = redis_conn.hgetall(PROGRESS_PREFIX + index_name)
+    if not progress:
+        return abort(404)
+
+    state = progress.pop('state', '')
+    progress = dict((field, float(value)) for field, value in progress.items())
+
+    # the loader has queued everything and the workers have indexed it all
+    if state == 'queued' and progress.get('hosts_indexed', 0) >= progress.get('hosts_queued', 0):
+        state = 'finished'
 
-    return jsonify({'result': 'successful', 'job_status': job.get_status()})
+    return jsonify({'result': 'successful', 'ingest_status': state, 'progress': progress})
@@ -0,0 +1,505 @@
+import argparse
+import cPickle as pickle
+import json
+import ntpath
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+from elasticsearch.serializer import JSONSerializer
+import loader
+import host_process
+import load_elastic
+from loader import CSV_COLUMNS, DATE_COLUMNS, DATE_FORMAT, normalize_chunk, iter_host_chunks
+from host_process import staging_dirs, recon_cmds, path_columns, extract_path_features_batch, extract_features
+from generate_data import generate_csv
+from forest import Forest
+
+'''
+Benchmarks for each stage of the ingest, run on a synthetic CSV so no customer data is needed
+Each stage runs in its own process against a fake Elasticsearch and a queue that records the jobs
+instead of sending them to Redis, and reports rows/sec and peak RSS. Redis isn't used at all, the
+metrics and progress are kept in the process like they are when Redis isn't available. The stages run in order, each
+one works on the jobs recorded by the stage before it:
+
+* normalize - normalize_chunk on every frame of hosts in the CSV
+* loader - loader.main reading the CSV and queueing host_process jobs
+* host_process - the feature extraction for each host_process job
+* load_elastic - serialising and bulk loading each load_elastic job
+* predict_data - scoring the loaded documents with a small forest (requires scikit-learn)
+'''
+
+STAGES = ['normalize', 'loader', 'host_process', 'load_elastic', 'predict_data']
+
+'''
+Stand-in for Elasticsearch, bulk requests are accepted without keeping the documents
+The number of documents is counted over every client, as each stage creates its own
+'''
+class FakeElasticsearch(object):
+    documents = 0
+
+    def __init__(self, *args, **kwargs):
+        self.transport = FakeTransport()
+
+    def bulk(self, body, index=None, doc_type=None, **kwargs):
+        items = []
+        lines = body.splitlines()
+        i = 0
+        while i < len(lines):
+            # every action is followed by its document, apart from delete
+            op_type = lines[i][2:lines[i].index('"', 2)]
+            items.append({op_type: {'status': 200}})
+            i += 1 if op_type == 'delete' else 2
+        FakeElasticsearch.documents += len(items)
+        return {'took': 1, 'errors': False, 'items': items}
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+class FakeIndicesClient(object):
+    def __init__(self, client):
+        pass
+
+    def exists(self, index):
+        return False
+
+    def create(self, index, body=None):
+        return {'acknowledged': True}
+
+'''
+Stand-in for the rq queues, jobs are pickled as rq would and kept for the next stage
+'''
+class RecordingQueue(object):
+    jobs = {}
+    rows = 0
+    # the jobs are never waiting to be run
+    count = 0
+
+    def __init__(self, name='default', connection=None):
+        pass
+
+    def enqueue(self, func, *args, **kwargs):
+        RecordingQueue.jobs.setdefault(func.__name__, []).append(pickle.dumps(args, pickle.HIGHEST_PROTOCOL))
+        # the jobs are (index_name, hosts)
+        if isinstance(args[1], list):
+            RecordingQueue.rows += sum(len(i) for i in args[1])
+
+# stand-in for the Redis connection, Metrics and Progress without a connection don't use Redis
+def no_redis(*args, **kwargs):
+    return None
+
+def use_fakes():
+    loader.Redis = host_process.Redis = load_elastic.Redis = no_redis
+    loader.Queue = host_process.Queue = RecordingQueue
+    loader.Elasticsearch = load_elastic.Elasticsearch = FakeElasticsearch
+    loader.IndicesClient = FakeIndicesClient
+
+def save_jobs(work_dir):
+    for name, jobs in RecordingQueue.jobs.items():
+        with open(os.path.join(work_dir, '{}.jobs'.format(name)), 'wb') as f:
+            pickle.dump(jobs, f, pickle.HIGHEST_PROTOCOL)
+
+def load_jobs(work_dir, name):
+    path = os.path.join(work_dir, '{}.jobs'.format(name))
+    if not os.path.exists(path):
+        raise Exception('No {} jobs in {}, run the stage before it first'.format(name, work_dir))
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+# create a run order for all hosts i.e. maintain appcompat order
+def create_run_order(val):
+    val['run_order'] = range(len(val))
+    return val
+
+# the normalisation as it was done before normalize_chunk, to compare against
+def normalize_chunk_reference(df):
+    df = df[df.hostname.notnull() & df.path.notnull()]
+
+    for i in DATE_COLUMNS:
+        df[i] = pd.to_datetime(df[i], format=DATE_FORMAT, errors='coerce')
+
+    df = df.groupby('hostname').apply(create_run_order)
+
+    df['hostname'] = df['hostname'].astype('category')
+    path = df['path'].str.lower()
+    path = path.str.replace(r'^unc', '\\\\', 1)
+    path = path.str.replace(r'^{}'.format(re.escape('\\??\\')), '', 1)
+    df['path'] = path.astype('category')
+
+    file_size = pd.to_numeric(df['file_size'], errors='coerce')
+    df['file_size'] = file_size.where(file_size == file_size.round()).astype('Int64')
+
+    file_executed = df['file_executed'].map({'True': True, 'Yes': True, 'False': False, 'No': False})
+    df['file_executed'] = pd.Categorical(file_executed, categories=[False, True])
+    return df
+
+'''
+The path features as they were extracted before extract_path_features_batch, one path at a time
+'''
+def shortname_ends_3264(shortname):
+    for i in ['32','64','86']:
+        if shortname.endswith(i):
+            return True
+    return False
+
+def path_depth(root):
+    if root == '\\':
+        return 0
+    else:
+        return root.count('\\')
+
+def staging_directory(root):
+    if root in staging_dirs:
+        return True
+
+    for i in staging_dirs:
+        if root.startswith(i+'\\'):
+            return True
+    return False
+
+def temp_dir(root):
+    return root.endswith('\\temp') or '\\temp\\' in root
+
+def system32_dir(root):
+    return root.endswith('\\system32') or '\\system32\\' in root
+
+def recon_cmd(file_root, file_shortname, file_ext):
+    for i in ['\\system32']:
+        if (file_root.endswith(i) or i in file_root) and file_ext == '.exe' and file_shortname in recon_cmds:
+            return True
+    return False
+
+def users_dir(root):
+    return root.startswith('\\users')
+
+def number_digits(path):
+    return sum(c.isdigit() for c in path)
+
+def executable_archive(root):
+    for i in ['7zs','rarsfx']:
+        if i in root:
+            return True
+    return False
+
+def extract_path_features(full_path):
+    unc,path = ntpath.splitunc(full_path)
+    drive = ''
+    if not unc:
+        drive,path = ntpath.splitdrive(full_path)
+
+    root,filename = ntpath.split(path)
+    shortname,ext = ntpath.splitext(filename)
+
+    # convert \sysvol\windows to sysvol:\windows
+    if not drive and root.startswith('sysvol'):
+        drive = 'sysvol:'
+        root = root.replace('sysvol', '', 1)
+
+    return pd.Series([
+            str(unc),
+            str(drive),
+            str(root),
+            shortname,
+            ext[1:],   # remove '.'
+            filename,
+            shortname_ends_3264(shortname),
+            path_depth(root),
+            len(root),
+            len(shortname),
+            staging_directory(root),
+            temp_dir(root),
+            system32_dir(root),
+            recon_cmd(root, shortname, ext),
+            users_dir(root),
+            number_digits(root+shortname),
+            executable_archive(root)])
+
+'''
+The per host features as they were before the batch versions, for a host sorted by run_order
+'''
+def recon_cluster(host_data):
+    recon_list = [0] * len(host_data)
+    run_order_list = host_data[host_data.f_recon_cmd]['run_order'].tolist()
+
+    if len(run_order_list) > 0:
+        clusters = []
+        # first cluster will contain at least the first element
+        cluster = [run_order_list[0]]
+        # iterator through the run_order_list and group by clusters
+        for i in xrange(len(run_order_list)-1):
+            # if the distance between two points is less-than-equal 5, it's part of the cluster
+            if run_order_list[i+1] - run_order_list[i] <= 5:
+                cluster.append(run_order_list[i+1])
+            # otherwise we create a new cluser
+            else:
+                clusters.append(cluster)
+                cluster = [run_order_list[i+1]]
+        clusters.append(cluster)
+        for i in clusters:
+            start = max(0, min(i)-3)
+            end = min(len(recon_list), max(i)+3)
+            for j in xrange(start,end):
+                recon_list[j] = len(i)
+    return pd.Series(recon_list)
+
+def neighbour_psexec(host_data):
+    recon_list = [False] * len(host_data)
+    run_order_list = host_data[host_data.file_shortname == 'psexesvc']['run_order'].tolist()
+
+    if len(run_order_list) > 0:
+        for i in run_order_list:
+            start = max(0, i-2)
+            end = min(len(recon_list), i+2)
+            for j in xrange(start,end):
+                recon_list[j] = True
+    return pd.Series(recon_list)
+
+def files_per_folder(host_data):
+    g = host_data.groupby('file_root')
+    tmp = g['file_name'].nunique().reset_index()
+    tmp.columns = ['file_root','f_files_in_folder']
+    return pd.merge(host_data, tmp, how='left', on=['file_root'])
+
+def same_timestamp_different_name(host_data):
+    g = host_data.groupby('last_modified')
+    tmp = g['file_name'].nunique().reset_index()
+    tmp.columns = ['last_modified','f_same_timestamp_different_name']
+    return pd.merge(host_data, tmp, how='left', on=['last_modified'])
+
+def same_filesize_different_name(host_data):
+    g = host_data.groupby('file_size')
+    tmp = g['file_name'].nunique().reset_index()
+    tmp.columns = ['file_size','f_same_filesize_different_name']
+    return pd.merge(host_data, tmp, how='left', on=['file_size'])
+
+# check the feature extraction for a host_process job against the reference versions
+def compare_features(hosts):
+    batch = pd.concat(hosts, ignore_index=True)
+
+    result = extract_path_features_batch(batch['path'])
+    reference = batch['path'].astype(object).apply(extract_path_features)
+    reference.columns = path_columns
+    for i in path_columns:
+        pd.testing.assert_series_equal(result[i].astype(object), reference[i].astype(object))
+
+    # each host sorted by run_order on its own, as host_process used to
+    features = extract_features(hosts)
+    batch = batch.join(reference)
+    for hostname, host_data in batch.groupby('hostname', observed=True):
+        host_data = host_data.sort_values(by='run_order').reset_index(drop=True)
+        host_features = features[features['hostname'] == hostname].reset_index(drop=True)
+        pd.testing.assert_series_equal(host_features['f_recon_cluster'], recon_cluster(host_data), check_names=False)
+        pd.testing.assert_series_equal(host_features['f_neighbour_psexec'], neighbour_psexec(host_data), check_names=False)
+
+        # file_size was a float column then, pandas can't merge on the nullable integers
+        host_data['file_size'] = host_data['file_size'].astype(float)
+        host_data = files_per_folder(host_data)
+        host_data = same_timestamp_different_name(host_data)
+        host_data = same_filesize_different_name(host_data)
+        # the counts were merged in, so rows without a timestamp or file size were left empty
+        for i in ['f_files_in_folder', 'f_same_timestamp_different_name', 'f_same_filesize_different_name']:
+            pd.testing.assert_series_equal(host_features[i], host_data[i].fillna(0), check_dtype=False)
+
+def read_frames(input_file, chunk_size):
+    chunk_iter = pd.read_csv(input_file, compression='infer',
+                             names=CSV_COLUMNS,
+                             usecols=['hostname','last_modified','last_execution','path','file_size','file_executed'],
+                             header=0,
+                             dtype=object,
+                             chunksize=chunk_size)
+    return list(iter_host_chunks(chunk_iter))
+
+# normalize_chunk over the whole file, optionally checked against the old normalisation
+def run_normalize(args):
+    frames = read_frames(args.input, args.chunk_size)
+
+    start = time.time()
+    results = [normalize_chunk(df) for df in frames]
+    elapsed = time.time() - start
+
+    if args.compare:
+        reference_start = time.time()
+        expected = [normalize_chunk_reference(df) for df in frames]
+        print 'groupby.apply normalisation: {:.3f}s'.format(time.time() - reference_start)
+
+        # and a chunk without a single last_execution, as some collections have
+        missing_dates = frames[0].assign(last_execution=None)
+        checked = results + [normalize_chunk(missing_dates)]
+        expected.append(normalize_chunk_reference(missing_dates))
+
+        # same rows and values, only the order of the categories can differ
+        for result, reference in zip(checked, expected):
+            for i in ['hostname', 'path']:
+                result[i] = result[i].astype(object)
+                reference[i] = reference[i].astype(object)
+            pd.testing.assert_frame_equal(result, reference)
+
+    return sum(len(i) for i in results), elapsed
+
+def run_loader(args):
+    sys.argv = ['loader.py', args.input, 'benchmark', '--chunk_size', str(args.chunk_size), '--compression', 'infer', '--path_hosts', 'sqlite']
+
+    start = time.time()
+    loader.main()
+    elapsed = time.time() - start
+
+    save_jobs(args.work_dir)
+    return RecordingQueue.rows, elapsed
+
+def run_host_process(args):
+    jobs = load_jobs(args.work_dir, 'host_process')
+
+    start = time.time()
+    rows = 0
+    for job in jobs:
+        job = pickle.loads(job)
+        rows += sum(len(i) for i in job[1])
+        host_process.host_process(*job)
+    elapsed = time.time() - start
+
+    if args.compare:
+        reference_start = time.time()
+        for job in jobs:
+            compare_features(pickle.loads(job)[1])
+        print 'per host feature extraction: {:.3f}s'.format(time.time() - reference_start)
+
+        # and rows without a timestamp or file size, which the generated data doesn't have
+        hosts = pickle.loads(jobs[0])[1]
+        missing = hosts[0].index[::7]
+        hosts[0].loc[missing, 'last_modified'] = pd.NaT
+        hosts[0].loc[missing, 'file_size'] = None
+        compare_features(hosts)
+
+    save_jobs(args.work_dir)
+    return rows, elapsed
+
+def run_load_elastic(args):
+    jobs = load_jobs(args.work_dir, 'load_elastic')
+
+    start = time.time()
+    for job in jobs:
+        load_elastic.load_elastic(*pickle.loads(job))
+    elapsed = time.time() - start
+
+    return FakeElasticsearch.documents, elapsed
+
+def run_predict_data(args):
+    import numpy as np
+    import predict_data
+    from sklearn.ensemble import ExtraTreesClassifier
+    predict_data.es = FakeElasticsearch()
+    predict_data.Redis = no_redis
+
+    # the documents as they would come back from a scan of the index
+    rows = []
+    for job in load_jobs(args.work_dir, 'load_elastic'):
+        index_name, hosts = pickle.loads(job)
+        for doc in load_elastic.serialize_hosts(hosts):
+            rows.append({'_index': index_name, '_id': str(len(rows)), '_source': json.loads(doc)})
+
+    # a small forest trained on random labels, only the scoring is timed
+    rng = np.random.RandomState(0)
+    sample = [rows[i] for i in rng.choice(len(rows), size=min(len(rows), 4096), replace=False)]
+    data = [[doc['_source'][i] for i in predict_data.columns] for doc in sample]
+    clf = ExtraTreesClassifier(n_estimators=100, random_state=0).fit(data, rng.randint(2, size=len(data)))
+
+    start = time.time()
+    for i in range(0, len(rows), predict_data.BATCHSIZE):
+        predict_data.predict_data(clf, rows[i:i+predict_data.BATCHSIZE])
+    elapsed = time.time() - start
+
+    if args.compare:
+        # the flattened forest has to give the same scores, its speed is reported to compare
+        forest = Forest.from_classifier(clf)
+        data = predict_data.feature_matrix([doc['_source'] for doc in rows], predict_data.columns)
+        reference_start = time.time()
+        expected = clf.predict_proba(data)
+        reference_elapsed = time.time() - reference_start
+        forest_start = time.time()
+        result = forest.predict_proba(data)
+        print 'classifier: {:.3f}s, flattened forest: {:.3f}s'.format(reference_elapsed, time.time() - forest_start)
+        np.testing.assert_array_equal(result, expected)
+
+    return len(rows), elapsed
+
+stage_runners = {
+    'normalize': run_normalize,
+    'loader': run_loader,
+    'host_process': run_host_process,
+    'load_elastic': run_load_elastic,
+    'predict_data': run_predict_data,
+}
+
+# run one stage in this process and write the result for the parent
+def run_stage(args):
+    use_fakes()
+    rows, elapsed = stage_runners[args.stage](args)
+
+    # kilobytes on linux, bytes on mac
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+
+    with open(os.path.join(args.work_dir, '{}.json'.format(args.stage)), 'w') as f:
+        json.dump({'rows': rows, 'seconds': elapsed, 'peak_rss': peak_rss}, f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the ingest on synthetic data")
+    parser.add_argument("--input", help="AppCompat CSV to use instead of generating one")
+    parser.add_argument("--hosts", type=int, default=1000, help="Number of hosts to generate. Default is 1000.")
+    parser.add_argument("--rows_per_host", type=int, default=200, help="Average rows per generated host. Default is 200.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the generated data. Default is 0.")
+    parser.add_argument("--chunk_size", type=int, default=250000, help="Loader chunk size. Default is 250000.")
+    parser.add_argument("--stages", default=','.join(STAGES), help="Comma separated stages to run. Default is all of them.")
+    parser.add_argument("--compare", action="store_true", help="Check normalize_chunk and the feature extraction against the old versions of them, and the flattened forest against the classifier")
+    parser.add_argument("--work_dir", help="Keep the CSV and recorded jobs in this directory, so later stages can be run again on their own")
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage(args)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp()
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    try:
+        if not args.input:
+            args.input = os.path.join(work_dir, 'appcompat.csv')
+            if not os.path.exists(args.input):
+                print 'Generating {} hosts...'.format(args.hosts)
+                generate_csv(args.input, args.hosts, rows_per_host=args.rows_per_host, seed=args.seed)
+
+        results = []
+        for stage in args.stages.split(','):
+            # a process per stage, so the peak RSS is just that stage
+            cmd = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--input', args.input,
+                   '--chunk_size', str(args.chunk_size), '--work_dir', work_dir]
+            if args.compare:
+                cmd.append('--compare')
+            if subprocess.call(cmd) != 0:
+                results.append((stage, None))
+                continue
+            with open(os.path.join(work_dir, '{}.json'.format(stage))) as f:
+                results.append((stage, json.load(f)))
+
+        print '{:<14}{:>12}{:>10}{:>14}{:>12}'.format('stage', 'rows', 'seconds', 'rows/sec', 'peak RSS')
+        for stage, result in results:
+            if result is None:
+                print '{:<14}{:>12}'.format(stage, 'failed')
+                continue
+            print '{:<14}{:>12}{:>10.2f}{:>14.0f}{:>9.0f} MB'.format(stage, result['rows'], result['seconds'],
+                                                               result['rows'] / max(result['seconds'], 1e-9),
+                                                               result['peak_rss'] / 1024.0 / 1024.0)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
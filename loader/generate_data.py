@@ -0,0 +1,166 @@
+import argparse
+import bz2
+import gzip
+import numpy as np
+import pandas as pd
+from host_process import recon_cmds
+
+'''
+Generate synthetic AppCompat CSVs for benchmarking, without needing customer data
+The same seed and options always give the same file. Hosts are written together in appcompat order,
+with paths stacked across hosts from a skewed pool of common paths, a share of paths only seen on
+one host, and occasional bursts of recon commands and psexec services.
+'''
+
+CSV_HEADER = ['Hostname','Last Modified','Last Update','Path','File Size','Exec Flag','Key Path']
+KEY_PATH = 'HKLM\\SYSTEM\\ControlSet001\\Control\\Session Manager\\AppCompatCache'
+PSEXEC_PATH = 'C:\\Windows\\PSEXESVC.EXE'
+
+common_dirs = ['C:\\Windows\\System32',
+               'C:\\Windows\\SysWOW64',
+               'C:\\Windows',
+               'C:\\Windows\\Microsoft.NET\\Framework\\v4.0.30319',
+               'C:\\Program Files\\{vendor}\\{product}',
+               'C:\\Program Files (x86)\\{vendor}\\{product}',
+               'C:\\ProgramData\\{vendor}\\Updater',
+               '\\??\\C:\\Windows\\System32',
+               'UNC\\fileserver\\deploy\\{product}']
+unique_dirs = ['C:\\Users\\{user}\\AppData\\Local\\Temp\\{hex}',
+               'C:\\Users\\{user}\\Downloads',
+               'C:\\Users\\{user}\\AppData\\Local\\Temp\\RarSFX{digit}',
+               'C:\\Windows\\Temp',
+               'C:\\$Recycle.Bin\\S-1-5-21-{digits}',
+               'C:\\PerfLogs',
+               'D:\\{hex}',
+               '\\??\\C:\\Users\\{user}\\AppData\\Roaming\\{product}']
+vendors = ['Microsoft', 'Adobe', 'Google', 'Mozilla', 'Oracle', 'VMware', 'Intel', 'Dell', 'Symantec', 'Citrix']
+products = ['Office', 'Reader', 'Chrome', 'Firefox', 'Java', 'Tools', 'Drivers', 'Support', 'Agent', 'Receiver']
+words = ['setup', 'update', 'install', 'svchost', 'helper', 'service', 'launcher', 'config', 'agent', 'host',
+         'sync', 'report', 'monitor', 'client', 'runtime', 'loader', 'manager', 'tray', 'notify', 'x64', 'w32']
+extensions = ['.exe', '.exe', '.exe', '.exe', '.dll', '.com', '.bat', '.scr']
+
+def random_path(rng, dirs):
+    directory = dirs[rng.randint(len(dirs))].format(vendor=vendors[rng.randint(len(vendors))],
+                                                    product=products[rng.randint(len(products))],
+                                                    user='user{}'.format(rng.randint(100)),
+                                                    hex='{:012x}'.format(rng.randint(2 ** 48)),
+                                                    digit=rng.randint(10),
+                                                    digits=rng.randint(10 ** 9))
+    name = words[rng.randint(len(words))]
+    if rng.rand() < 0.3:
+        name += str(rng.randint(100))
+    return '{}\\{}{}'.format(directory, name, extensions[rng.randint(len(extensions))])
+
+def random_dates(rng, size, start='2014-01-01', days=730):
+    seconds = rng.randint(days * 24 * 3600, size=size)
+    dates = pd.Timestamp(start) + pd.to_timedelta(seconds, unit='s')
+    return dates.strftime('%m/%d/%y %H:%M:%S').values.astype(object)
+
+'''
+Generate the rows for blocks of hosts, yielding a frame per block
+rows_per_host is the mean of a poisson distribution, path_skew is the zipf exponent of the common
+paths (higher stacks more), unique_paths is the share of rows with a path only on that host and
+recon_rate / psexec_rate are the share of hosts with a recon burst / psexec service
+'''
+def generate_hosts(hosts, rows_per_host=200, paths=5000, path_skew=1.1, unique_paths=0.05,
+                   recon_rate=0.02, psexec_rate=0.01, seed=0, block_size=1000):
+    rng = np.random.RandomState(seed)
+
+    # the pool of paths seen across hosts, along with their usual size and timestamp
+    pool = np.array([random_path(rng, common_dirs) for i in range(paths)], dtype=object)
+    pool_sizes = rng.lognormal(12, 2, size=paths).astype(np.int64).astype(str).astype(object)
+    pool_dates = random_dates(rng, paths)
+    dates = random_dates(rng, 50000)
+    weights = 1.0 / np.arange(1, paths + 1) ** path_skew
+    weights /= weights.sum()
+
+    recon_paths = np.array(['C:\\Windows\\System32\\{}.exe'.format(i) for i in recon_cmds], dtype=object)
+
+    for block_start in range(0, hosts, block_size):
+        block_hosts = min(block_size, hosts - block_start)
+        lengths = np.maximum(rng.poisson(rows_per_host, size=block_hosts), 1)
+        rows = lengths.sum()
+        starts = np.cumsum(lengths) - lengths
+
+        # common paths keep their size and timestamp most of the time
+        path_index = rng.choice(paths, size=rows, p=weights)
+        path = pool[path_index]
+        file_size = pool_sizes[path_index]
+        last_modified = pool_dates[path_index]
+        changed = rng.rand(rows) < 0.1
+        last_modified[changed] = dates[rng.randint(len(dates), size=changed.sum())]
+
+        # paths only seen on this host
+        unique = np.flatnonzero(rng.rand(rows) < unique_paths)
+        path[unique] = [random_path(rng, unique_dirs) for i in unique]
+        file_size[unique] = rng.lognormal(11, 2, size=len(unique)).astype(np.int64).astype(str)
+        last_modified[unique] = dates[rng.randint(len(dates), size=len(unique))]
+
+        # a run of recon commands close together
+        for host in np.flatnonzero(rng.rand(block_hosts) < recon_rate):
+            burst = min(rng.randint(3, 9), lengths[host])
+            start = starts[host] + rng.randint(lengths[host] - burst + 1)
+            path[start:start + burst] = recon_paths[rng.choice(len(recon_paths), size=burst, replace=False)]
+
+        # a psexec service followed by the tools it ran
+        for host in np.flatnonzero(rng.rand(block_hosts) < psexec_rate):
+            start = starts[host] + rng.randint(lengths[host])
+            path[start] = PSEXEC_PATH
+            for i in range(start + 1, min(start + 3, starts[host] + lengths[host])):
+                path[i] = random_path(rng, unique_dirs)
+
+        last_execution = np.where(rng.rand(rows) < 0.4, dates[rng.randint(len(dates), size=rows)], 'N/A').astype(object)
+        file_size[rng.rand(rows) < 0.1] = 'N/A'
+        file_executed = np.array(['True', 'False', 'N/A'], dtype=object)[rng.choice(3, size=rows, p=[0.3, 0.3, 0.4])]
+        hostname = np.array(['HOST{:06d}'.format(block_start + i) for i in range(block_hosts)], dtype=object)
+
+        yield pd.DataFrame({
+            'Hostname': np.repeat(hostname, lengths),
+            'Last Modified': last_modified,
+            'Last Update': last_execution,
+            'Path': path,
+            'File Size': file_size,
+            'Exec Flag': file_executed,
+            'Key Path': KEY_PATH,
+        }, columns=CSV_HEADER)
+
+def open_output(output_file, compression=None):
+    if compression == 'infer':
+        compression = {'gz': 'gzip', 'bz2': 'bz2'}.get(output_file.rsplit('.', 1)[-1])
+    if compression == 'gzip':
+        return gzip.open(output_file, 'wb', 6)
+    if compression == 'bz2':
+        return bz2.BZ2File(output_file, 'wb')
+    return open(output_file, 'wb')
+
+# write the generated hosts to a CSV, returns the number of rows
+def generate_csv(output_file, hosts, compression='infer', **kwargs):
+    rows = 0
+    with open_output(output_file, compression) as f:
+        for n, block in enumerate(generate_hosts(hosts, **kwargs)):
+            block.to_csv(f, index=False, header=n == 0)
+            rows += len(block)
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a synthetic AppCompat CSV for benchmarking the loader")
+    parser.add_argument("output_file", help="CSV file to write")
+    parser.add_argument("--hosts", type=int, default=1000, help="Number of hosts. Default is 1000.")
+    parser.add_argument("--rows_per_host", type=int, default=200, help="Average rows per host. Default is 200.")
+    parser.add_argument("--paths", type=int, default=5000, help="Number of common paths stacked across hosts. Default is 5000.")
+    parser.add_argument("--path_skew", type=float, default=1.1, help="Zipf exponent of the common paths, higher stacks more. Default is 1.1.")
+    parser.add_argument("--unique_paths", type=float, default=0.05, help="Share of rows with a path only seen on that host. Default is 0.05.")
+    parser.add_argument("--recon_rate", type=float, default=0.02, help="Share of hosts with a burst of recon commands. Default is 0.02.")
+    parser.add_argument("--psexec_rate", type=float, default=0.01, help="Share of hosts with a psexec service. Default is 0.01.")
+    parser.add_argument("--compression", choices=['infer','gzip','bz2'], default='infer', help="Compress the CSV (default infers it from the file extension)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. Default is 0.")
+    args = parser.parse_args()
+
+    rows = generate_csv(args.output_file, args.hosts, compression=args.compression,
+                        rows_per_host=args.rows_per_host, paths=args.paths, path_skew=args.path_skew,
+                        unique_paths=args.unique_paths, recon_rate=args.recon_rate,
+                        psexec_rate=args.psexec_rate, seed=args.seed)
+    print 'Wrote {} rows for {} hosts to {}'.format(rows, args.hosts, args.output_file)
+
+if __name__ == '__main__':
+    main()
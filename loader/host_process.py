@@ -1,280 +1,367 @@
-import ntpath
+import os
+import re
+import uuid
+import numpy as np
 import pandas as pd
 from rq import Queue
 from redis import Redis
 from load_elastic import load_elastic
+from spool import spool_hosts, unspool_hosts, release_hosts
+from metrics import Metrics, hosts_bytes
+from progress import Progress, current_job_id
 
-'''
-Does the filename end with 32, 64, 86 (eg. wce32.exe)?
-Threat actors like to label their tools for this
-'''
-def shortname_ends_3264(shortname):
-    for i in ['32','64','86']:
-        if shortname.endswith(i):
-            return True
-    return False
+# known staging directories (relative to the drive)
+staging_dirs = ['\\$recycle.bin', 
+                '\\programdata', 
+                '\\windows\\debug', 
+                '\\recycler', 
+                '\\system volume information', 
+                '\\intel', 
+                '\\hp', 
+                '\\dell', 
+                '\\recovery', 
+                '\\perflogs', 
+                '\\drivers']
 
-'''
-How depth is the path structure?
-Threat actors rarely use deep paths for tools (however, backdoors may have deep paths)
-'''
-def path_depth(root):
-    if root == '\\':
-        return 0
-    else:
-        return root.count('\\')
+# windows commands commonly used for recon
+recon_cmds = ['net',
+              'ping',
+              'tasklist',
+              'ipconfig',
+              'quser',
+              'query',
+              'netstat',
+              'whoami',
+              'qwinsta',
+              'dsquery',
+              'arp',
+              'hostname',
+              'systeminfo',
+              'nltest',
+              'cscript',
+              'at',
+              'ftp',
+              'powershell',
+              'wmic',
+              'nslookup',
+              'tracert',
+              'route']
 
-'''
-Is the file in a known staging directory?
-Threat actors like to store their tools in preexisting directories and that are preferably empty
-'''
-def staging_directory(root):
-    dirs = ['\\$recycle.bin', 
-              '\\programdata', 
-              '\\windows\\debug', 
-              '\\recycler', 
-              '\\system volume information', 
-              '\\intel', 
-              '\\hp', 
-              '\\dell', 
-              '\\recovery', 
-              '\\perflogs', 
-              '\\drivers']
-    if root in dirs:
-        return True
-    
-    for i in dirs:
-        if root.startswith(i+'\\'):
-            return True
-    return False
+# codes and distinct values of a column, categorical columns already have them
+def factorize(values):
+    if values.dtype.name == 'category':
+        return values.cat.codes.values, values.cat.categories
+    return pd.factorize(values)
+
+# columns produced by the path feature extraction (in order)
+path_columns = ['file_unc','file_drive','file_root','file_shortname','file_ext','file_name',
+                'f_shortname_ends_3264','f_path_depth','f_root_length','f_shortname_length',
+                'f_staging_directory','f_temp_dir','f_system32_dir','f_recon_cmd','f_users_dir',
+                'f_number_digits','f_executable_archive']
+
+# ntpath.splitunc only accepts a '\\' or '//' prefix, ntpath.splitdrive accepts any mix of separators
+UNC_PATTERN = r'(?:\\\\|//)[^\\/]+[\\/](?:[^\\/]+|\Z)'
+DRIVE_PATTERN = r'(?:[\\/]{2}[^\\/]+[\\/](?:[^\\/]+|\Z)|[\s\S]:)'
 
 '''
-Is the file in a temp directory?
-Threat actors like to write to temp directories (always has write permissions)
+Directory and command rules used for the boolean path features
+Each feature is true when all of its conditions hold, and a condition holds when any of its
+strings match. New staging directories or recon commands only need to be added to the lists
+above, all of the rules are compiled into a single regex by compile_path_rules.
+    prefix     - root starts with the string
+    dir_prefix - root is the directory or is below it
+    dir        - root contains the directory
+    contains   - root contains the string
+    filename   - filename is the string
 '''
-def temp_dir(root):
-    return root.endswith('\\temp') or '\\temp\\' in root
+path_rules = [
+    ('f_staging_directory', [('dir_prefix', staging_dirs)]),
+    ('f_temp_dir', [('dir', ['\\temp'])]),
+    ('f_system32_dir', [('dir', ['\\system32'])]),
+    ('f_recon_cmd', [('contains', ['\\system32']), ('filename', [i + '.exe' for i in recon_cmds])]),
+    ('f_users_dir', [('prefix', ['\\users'])]),
+    ('f_executable_archive', [('contains', ['7zs', 'rarsfx'])])
+]
+
+# the root and filename are matched together as root + '\n' + filename (can't appear in a path)
+RULE_PATTERNS = {
+    'prefix': r'{}',
+    'dir_prefix': r'{}(?:\\|\n)',
+    'dir': r'[^\n]*?{}(?:\\|\n)',
+    'contains': r'[^\n]*?{}',
+    'filename': r'[^\n]*\n{}\Z'
+}
 
 '''
-Is the file in the system32 directory?
-Threat actors like to store backdoors in the system32 directory
+Compile the rules into one regex, every feature is an optional empty named group guarded by
+lookaheads so a single match against each root reports all of the features at once
 '''
-def system32_dir(root):
-    return root.endswith('\\system32') or '\\system32\\' in root
+def compile_path_rules(rules):
+    groups = []
+    for name, conditions in rules:
+        lookaheads = ''
+        for kind, strings in conditions:
+            alternatives = '(?:' + '|'.join(re.escape(i) for i in strings) + ')'
+            lookaheads += '(?=' + RULE_PATTERNS[kind].format(alternatives) + ')'
+        groups.append('(?:{}(?P<{}>))?'.format(lookaheads, name))
+    return re.compile('^' + ''.join(groups))
+
+path_rules_regex = compile_path_rules(path_rules)
 
 '''
-Is the file a windows recon file?
-This is required for clustering of recon files
+Classify a batch of roots/filenames against all of the path rules in a single pass
+Returns a boolean column per rule
 '''
-def recon_cmd(file_root, file_shortname, file_ext):
-    cmds = ['net',
-            'ping',
-            'tasklist',
-            'ipconfig',
-            'quser',
-            'query',
-            'netstat',
-            'whoami',
-            'qwinsta',
-            'dsquery',
-            'arp',
-            'hostname',
-            'systeminfo',
-            'nltest',
-            'cscript',
-            'at',
-            'ftp',
-            'powershell',
-            'wmic',
-            'nslookup',
-            'tracert',
-            'route']
-    for i in ['\\system32']: #'\\syswow64', '\\sysnative']:
-        if (file_root.endswith(i) or i in file_root) and file_ext == '.exe' and file_shortname in cmds:
-            return True
-    return False 
+def match_path_rules(root, filename, regex=path_rules_regex):
+    matches = (root + '\n' + filename).str.extract(regex, expand=True)
+    return matches.notnull()
 
 '''
-Is the file in the users directory?
-Common for 1st stage backdoors to be in this directory and hence, threat actor may use tools here as well (cwd)
+Split up the paths of a whole batch and extract the path features, the paths are split like
+ntpath.splitunc/splitdrive, ntpath.split and ntpath.splitext would
+Appcompat data repeats the same paths across hosts, so each distinct path is only split once
+and the results are broadcast back out to the rows.
 '''
-def users_dir(root):
-    return root.startswith('\\users')
+def extract_path_features_batch(paths):
+    codes, uniques = factorize(paths)
+    full_path = pd.Series(uniques, dtype=object)
+
+    # ntpath.splitunc, falling back to ntpath.splitdrive
+    unc_split = full_path.str.extract(r'^(' + UNC_PATTERN + r')?([\s\S]*)\Z', expand=True).fillna('')
+    drive_split = full_path.str.extract(r'^(' + DRIVE_PATTERN + r')?([\s\S]*)\Z', expand=True).fillna('')
+    is_unc = unc_split[0] != ''
+    unc = unc_split[0]
+    drive = drive_split[0].where(~is_unc, '')
+    path = unc_split[1].where(is_unc, drive_split[1])
+
+    # ntpath.split (which calls splitdrive again on what is left) and ntpath.splitext
+    split = path.str.extract(r'^(' + DRIVE_PATTERN + r')?([\s\S]*?)([^\\/]*)\Z', expand=True).fillna('')
+    head = split[1].str.rstrip('\\/')
+    root = split[0] + head.where(head != '', split[1])
+    filename = split[2]
+    ext_split = filename.str.extract(r'^([\s\S]*)(\.[^.]*)\Z', expand=True)
+    has_ext = ext_split[0].str.contains(r'[^.]', na=False)  # leading dots are not an extension
+    shortname = ext_split[0].where(has_ext, filename)
+    ext = ext_split[1].where(has_ext, '')
+
+    # convert \sysvol\windows to sysvol:\windows
+    sysvol = (drive == '') & root.str.startswith('sysvol')
+    drive = drive.where(~sysvol, 'sysvol:')
+    root = root.where(~sysvol, root.str[len('sysvol'):])
+
+    features = pd.DataFrame({
+        'file_unc': unc,
+        'file_drive': drive,
+        'file_root': root,
+        'file_shortname': shortname,
+        'file_ext': ext.str[1:],   # remove '.'
+        'file_name': filename,
+        'f_shortname_ends_3264': shortname.str[-2:].isin(['32','64','86']),
+        'f_path_depth': root.str.count(r'\\').where(root != '\\', 0),
+        'f_root_length': root.str.len(),
+        'f_shortname_length': shortname.str.len(),
+        'f_number_digits': (root + shortname).str.count(r'[0-9]')})
+    features = features.join(match_path_rules(root, filename))[path_columns]
+
+    # broadcast back out to every row of the batch, the strings as categoricals
+    result = pd.DataFrame(index=paths.index)
+    for i in path_columns:
+        if features[i].dtype == object:
+            value_codes, values = pd.factorize(features[i])
+            result[i] = pd.Categorical.from_codes(value_codes[codes], values)
+        else:
+            result[i] = features[i].values[codes]
+    return result
 
 '''
-How many digits in path?
-Never seen more than 2 or 3. This will filter at random generated paths (d:\4563bb32f7060ac2f373fe2d81d0\install.exe)
+Where each host starts and ends in a batch sorted by hostname
+Returns the host number, start and end row of each row
 '''
-def number_digits(path):
-    return sum(c.isdigit() for c in path)
+def host_bounds(batch):
+    hostname = factorize(batch['hostname'])[0]
+    new_host = np.ones(len(hostname), dtype=bool)
+    new_host[1:] = hostname[1:] != hostname[:-1]
+    starts = np.flatnonzero(new_host)
+    ends = np.append(starts[1:], len(hostname))
+    host_id = np.cumsum(new_host) - 1
+    return host_id, starts[host_id], ends[host_id]
 
 '''
-Is the file part of an extracted archive?
-Common attack vector for user to run executable archives
+Mark [lo, hi) windows of a batch with a value using a cumulative sum instead of filling lists
+Windows with the same value are allowed to overlap, returns the sum of the values covering each row
 '''
-def executable_archive(root):
-    for i in ['7zs','rarsfx']:
-        if i in root:
-            return True
-    return False
-    
-'''
-Split up the path and extract the features
-'''    
-def extract_path_features(full_path):
-    
-    unc,path = ntpath.splitunc(full_path)
-    drive = ''
-    if not unc:
-        drive,path = ntpath.splitdrive(full_path)
-        
-    root,filename = ntpath.split(path)
-    shortname,ext = ntpath.splitext(filename)
-    
-    # convert \sysvol\windows to sysvol:\windows
-    if not drive and root.startswith('sysvol'):
-        drive = 'sysvol:'
-        root = root.replace('sysvol', '', 1)
-                
-    return pd.Series([
-            str(unc),
-            str(drive),
-            str(root),
-            shortname,
-            ext[1:],   # remove '.'
-            filename,
-            shortname_ends_3264(shortname),
-            path_depth(root),
-            len(root),
-            len(shortname),
-            staging_directory(root),
-            temp_dir(root),
-            system32_dir(root),
-            recon_cmd(root, shortname, ext),
-            users_dir(root),
-            number_digits(root+shortname),
-            executable_archive(root)])
+def mark_windows(length, lo, hi, value):
+    valid = lo < hi
+    marks = np.zeros(length + 1, dtype=np.int64)
+    np.add.at(marks, lo[valid], value[valid])
+    np.add.at(marks, hi[valid], -value[valid])
+    return np.cumsum(marks[:-1])
 
 '''
-Is the file within a cluster of windows recon commands?
+Is the file within a cluster of windows recon commands? Returns the size of the cluster, or 0
 Threat actors will typically run recon commands once they connect to their backdoor
+Recon commands at most 5 apart are a cluster, which covers the rows from 3 before its first
+command to 2 after its last. Expects the batch sorted by hostname and run_order.
 '''
-def recon_cluster(host_data):
-    recon_list = [0] * len(host_data)
-    run_order_list = host_data[host_data.f_recon_cmd]['run_order'].tolist()
-    
-    if len(run_order_list) > 0:
-        clusters = []
-        # first cluster will contain at least the first element
-        cluster = [run_order_list[0]]
-        # iterator through the run_order_list and group by clusters
-        for i in xrange(len(run_order_list)-1):
-            # if the distance between two points is less-than-equal 5, it's part of the cluster 
-            if run_order_list[i+1] - run_order_list[i] <= 5:
-                cluster.append(run_order_list[i+1])
-            # otherwise we create a new cluser
-            else:
-                clusters.append(cluster)
-                cluster = [run_order_list[i+1]]
-        clusters.append(cluster)
-        for i in clusters:
-            start = max(0, min(i)-3)
-            end = min(len(recon_list), max(i)+3)
-            for j in xrange(start,end):
-                recon_list[j] = len(i)
-    return pd.Series(recon_list)
+def recon_cluster_batch(batch):
+    host_id, start, end = host_bounds(batch)
+    recon = np.flatnonzero(batch['f_recon_cmd'].values)
+    run_order = batch['run_order'].values.astype(np.int64)[recon]
+
+    # a new cluster starts on a new host or when the distance to the last recon command is more than 5
+    new_cluster = np.ones(len(recon), dtype=bool)
+    new_cluster[1:] = (host_id[recon][1:] != host_id[recon][:-1]) | (np.diff(run_order) > 5)
+    first = np.flatnonzero(new_cluster)
+    last = np.append(first[1:], len(recon))[:len(first)] - 1
+
+    # clusters are at least 6 apart, so the windows never overlap
+    host_start = start[recon][first]
+    host_len = end[recon][first] - host_start
+    lo = host_start + np.minimum(host_len, np.maximum(0, run_order[first] - 3))
+    hi = host_start + np.minimum(host_len, run_order[last] + 3)
+    return pd.Series(mark_windows(len(batch), lo, hi, last - first + 1), index=batch.index)
 
 '''
-Is the file neighboured with psexec?
+Is the file neighboured with psexec? True from 2 rows before a psexesvc to the row after it
 Common lateral movement technique is to use psexec, which will have a new psexesvc service close by
+Expects the batch sorted by hostname and run_order.
 '''
-def neighbour_psexec(host_data):
-    recon_list = [False] * len(host_data)
-    run_order_list = host_data[host_data.file_shortname == 'psexesvc']['run_order'].tolist()
-    
-    if len(run_order_list) > 0:
-        for i in run_order_list:
-            start = max(0, i-2)
-            end = min(len(recon_list), i+2)
-            for j in xrange(start,end):
-                recon_list[j] = True
-    return pd.Series(recon_list)
+def neighbour_psexec_batch(batch):
+    host_id, start, end = host_bounds(batch)
+    psexec = np.flatnonzero((batch['file_shortname'] == 'psexesvc').values)
+    run_order = batch['run_order'].values.astype(np.int64)[psexec]
 
-'''
-How many files have been seen in this directory?
-Threat actors are likely to run more than one tool in any given path
-'''
-def files_per_folder(host_data):
-    g = host_data.groupby('file_root')
-    tmp = g['file_name'].nunique().reset_index()
-    tmp.columns = ['file_root','f_files_in_folder']
-    return pd.merge(host_data, tmp, how='left', on=['file_root'])
+    host_start = start[psexec]
+    host_len = end[psexec] - host_start
+    lo = host_start + np.minimum(host_len, np.maximum(0, run_order - 2))
+    hi = host_start + np.minimum(host_len, run_order + 2)
+    return pd.Series(mark_windows(len(batch), lo, hi, np.ones(len(psexec), dtype=np.int64)) > 0, index=batch.index)
+
+# (key, feature) pairs counting the distinct file names seen per host and key
+cardinality_features = [('file_root', 'f_files_in_folder'),
+                        ('last_modified', 'f_same_timestamp_different_name'),
+                        ('file_size', 'f_same_filesize_different_name')]
 
 '''
-Do any files share a timestamp but have different names?
-This can be used to detect timestomping, e.g. bad.exe timestomped from cmd.exe
+How many different file names share the directory, timestamp or file size of each file on its host?
+Threat actors are likely to run more than one tool in any given path, timestomp their tools from
+another file (e.g. bad.exe timestomped from cmd.exe) and copy the same tool into multiple staging
+directories under different names
+Counts the distinct file names per (hostname, key) group for the whole batch and broadcasts the
+counts back to the rows, without merging. Rows with a missing key get 0.
 '''
-def same_timestamp_different_name(host_data):
-    g = host_data.groupby('last_modified')
-    tmp = g['file_name'].nunique().reset_index()
-    tmp.columns = ['last_modified','f_same_timestamp_different_name']
-    return pd.merge(host_data, tmp, how='left', on=['last_modified'])
+def host_cardinality_batch(batch, features=cardinality_features):
+    host = factorize(batch['hostname'])[0].astype(np.int64)
+    name, names = factorize(batch['file_name'])
+
+    result = pd.DataFrame(index=batch.index)
+    for key_column, column in features:
+        key, keys = factorize(batch[key_column])
+        has_key = key >= 0
+
+        # number the (hostname, key) groups, then count the distinct (group, name) pairs in each
+        group, groups = pd.factorize(host[has_key] * len(keys) + key[has_key])
+        pairs = np.unique(group.astype(np.int64) * len(names) + name[has_key])
+        counts = np.bincount(pairs // len(names), minlength=len(groups))
+
+        values = np.zeros(len(batch), dtype=np.int64)
+        values[has_key] = counts[group]
+        result[column] = values
+    return result
 
 '''
-Do any files share a filesize but have different names?
-This can be used to detect backdoors or tools used in multiple staging directories
+Extract the features for a batch of hosts, returns the batch as one frame ready to be loaded
 '''
-def same_filesize_different_name(host_data):
-    g = host_data.groupby('file_size')
-    tmp = g['file_name'].nunique().reset_index()
-    tmp.columns = ['file_size','f_same_filesize_different_name']
-    return pd.merge(host_data, tmp, how='left', on=['file_size'])
-
-def host_process(index_name, hosts):
-    columns = ['file_unc','file_drive','file_root','file_shortname','file_ext','file_name',
-               'f_shortname_ends_3264','f_path_depth','f_root_length','f_shortname_length',
-               'f_staging_directory','f_temp_dir','f_system32_dir','f_recon_cmd','f_users_dir',
-               'f_number_digits','f_executable_archive']
+def extract_features(hosts):
+    # split the paths for the whole batch at once, hosts from different chunks can share index values
+    batch = pd.concat(hosts, ignore_index=True)
+    batch = batch.join(extract_path_features_batch(batch['path']))
 
-    # Tell RQ what Redis connection to use
-    redis_conn = Redis()
-    q = Queue('high',connection=redis_conn)  # high queue to get data out of memory faster
+    # make sure we use the actual appcompat correct order
+    batch = batch.sort_values(by=['hostname','run_order']).reset_index(drop=True)
 
-    result_hosts = []
-    for host_data in hosts:
-        x = host_data['path'].apply(extract_path_features)
-        x.columns = columns
-        host_data = host_data.join(x)
+    batch['f_recon_cluster'] = recon_cluster_batch(batch)
+    batch['f_neighbour_psexec'] = neighbour_psexec_batch(batch)
 
-        # make sure we use the actual appcompat correct order
-        host_data = host_data.sort_values(by='run_order')
+    batch = batch.join(host_cardinality_batch(batch))
 
-        # reset the index, as this will allows us to add columns of lists easily
-        host_data = host_data.reset_index()
-        del host_data['index'] # delete the old index column
+    # create empty columns for later
+    batch['class_label'] = ''
+    batch['predict'] = 0.0
 
-        host_data['f_recon_cluster'] = recon_cluster(host_data)
-        host_data['f_neighbour_psexec'] = neighbour_psexec(host_data)
-        host_data = files_per_folder(host_data)
-        host_data = same_timestamp_different_name(host_data)
-        host_data = same_filesize_different_name(host_data)
+    # no longer need this data, might as well remove it and save some space
+    for i in ['file_unc','file_drive','file_root','file_shortname','file_ext','file_name']:
+        del batch[i]
 
-        # create empty columns for later
-        host_data['class_label'] = ''
-        host_data['predict'] = 0.0
+    return batch
 
-        # default values
-        host_data['f_same_timestamp_different_name'] = host_data['f_same_timestamp_different_name'].fillna(0)
-        host_data['f_same_filesize_different_name'] = host_data['f_same_filesize_different_name'].fillna(0)
+# score the batch at ingest, the workers only need scikit-learn when this is used
+def score_hosts(index_name, batch, model_version, metrics, redis_conn):
+    from predict_data import score_batch
+    with metrics.timed(index_name, 'predict', rows=len(batch)):
+        score_batch(batch, model_version, redis_conn)
 
-        # no longer need this data, might as well remove it and save some space
-        for i in ['file_unc','file_drive','file_root','file_shortname','file_ext','file_name']:
-            del host_data[i]
+'''
+Extract the features for a batch of hosts and queue it to be loaded
+With a model_version the batch is scored with that model from the registry before it's loaded
+'''
+def host_process(index_name, hosts, spool_dir=None, model_version=None):
+    payload = hosts
 
-        # batch up results and submit to queue
-        result_hosts.append(host_data)
+    # Tell RQ what Redis connection to use
+    redis_conn = Redis()
+    q = Queue('high',connection=redis_conn)  # high queue to get data out of memory faster
+    metrics = Metrics(redis_conn)
+    progress = Progress(redis_conn, index_name)
+
+    try:
+        with metrics.timed(index_name, 'extract') as counts:
+            hosts = unspool_hosts(payload)
+            if len(hosts) == 0:
+                return
+            counts['rows'] = sum(len(i) for i in hosts)
+            counts['bytes'] = hosts_bytes(hosts)
+
+            batch = extract_features(hosts)
 
-    if len(result_hosts) > 0:
-        q.enqueue(load_elastic, index_name, result_hosts)
+        if model_version:
+            score_hosts(index_name, batch, model_version, metrics, redis_conn)
 
+        # the high queue is full, load the batch here rather than adding to it
+        if progress.over_limit(q):
+            progress.processed(batch['hostname'].nunique(), len(batch))
+            load_elastic(index_name, [batch], metrics, progress, redis_conn)
+        else:
+            job_id = str(uuid.uuid4())
+            if spool_dir:
+                load_payload = spool_hosts([batch], spool_dir)
+                bytes = os.path.getsize(load_payload)
+            else:
+                load_payload = [batch]
+                bytes = hosts_bytes(load_payload)
+            # counted as in flight before it's queued, in case it's finished before we get back
+            progress.processed(batch['hostname'].nunique(), len(batch), job_id, bytes)
+            q.enqueue(load_elastic, index_name, load_payload, job_id=job_id)
+        release_hosts(payload)
+    finally:
+        progress.release(current_job_id())
 
+'''
+Same as host_process, but loads the batch straight away instead of queuing it
+Used by the loader's --local mode, which runs this in a process pool
+Returns the metrics kept in this process when Redis isn't available, for the loader to add up
+'''
+def local_process(index_name, hosts, model_version=None):
+    if len(hosts) == 0:
+        return {}
+
+    redis_conn = Redis()
+    metrics = Metrics(redis_conn)
+    progress = Progress(redis_conn, index_name)
+    with metrics.timed(index_name, 'extract', rows=sum(len(i) for i in hosts), bytes=hosts_bytes(hosts)):
+        batch = extract_features(hosts)
+    if model_version:
+        score_hosts(index_name, batch, model_version, metrics, redis_conn)
+    progress.processed(batch['hostname'].nunique(), len(batch))
+    load_elastic(index_name, [batch], metrics, progress, redis_conn)
+    return metrics.local
@@ -1,19 +1,93 @@
+import logging
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import *
+from redis import Redis
+from redis.exceptions import RedisError
+from spool import unspool_hosts, release_hosts
+from metrics import Metrics
+from progress import Progress, current_job_id
+from rescore_coverage import RescoreCoverage
 
-def load_elastic(index_name, hosts):
-    es = Elasticsearch()
-    actions = []
+# bulk requests are split up by size rather than by the number of documents
+BULK_CHUNK_BYTES = 10 * 1024 * 1024
+BULK_CHUNK_DOCS = 1000000
+# number of threads sending bulk requests (1 sends them in order from this thread)
+BULK_THREADS = 1
 
+'''
+Serialise host frames into documents for the bulk API
+Each frame is converted to JSON lines in one pass, giving the same documents as calling
+to_json(date_format='iso') on each row (iso dates, NaN/None as null, bools and ints as is)
+'''
+def serialize_hosts(hosts):
     for host in hosts:
-        for i in host.iterrows():
-            action = {
-                "_index": index_name,
-                "_type": "appcompat",
-                "_source": i[1].to_json(date_format='iso')
-            }
+        if len(host) == 0:
+            continue
+        for doc in host.to_json(orient='records', lines=True, date_format='iso').split('\n'):
+            yield doc
+
+# count the documents and bytes as they're sent
+def count_docs(docs, counts):
+    for doc in docs:
+        counts['rows'] += 1
+        counts['bytes'] += len(doc)
+        yield doc
+
+'''
+Documents scored at ingest are about to be written with their model versions, so a rescore can't
+count on having checked every document of these versions. Recorded before the documents are
+written, and like metrics and progress it must never fail the ingest.
+'''
+def record_scored(redis_conn, index_name, batch):
+    versions = set()
+    for host in batch:
+        if 'model_version' in host:
+            versions.update(host['model_version'].dropna().unique())
+    try:
+        coverage = RescoreCoverage(redis_conn)
+        for version in versions:
+            coverage.scored(index_name, version)
+    except RedisError:
+        logging.warning('Could not record the model versions scored at ingest for %s', index_name)
+
+'''
+Bulk load a batch of hosts into Elasticsearch
+metrics and progress are passed in when the batch is loaded as part of another job, otherwise this
+is a job of its own and releases its payload from the in flight bytes when it's finished
+redis_conn is the connection of the job calling this, if there is one
+'''
+def load_elastic(index_name, hosts, metrics=None, progress=None, redis_conn=None):
+    es = Elasticsearch()
+    job_id = None
+    if redis_conn is None:
+        redis_conn = Redis()
+    if metrics is None or progress is None:
+        metrics = metrics or Metrics(redis_conn)
+        if progress is None:
+            progress = Progress(redis_conn, index_name)
+            job_id = current_job_id()
+
+    try:
+        with metrics.timed(index_name, 'load') as counts:
+            batch = unspool_hosts(hosts)
+            record_scored(redis_conn, index_name, batch)
+
+            # documents are passed as pre-serialised strings, so the index and type go on the bulk request
+            docs = count_docs(serialize_hosts(batch), counts)
+            if BULK_THREADS > 1:
+                results = parallel_bulk(es, docs, thread_count=BULK_THREADS,
+                                        chunk_size=BULK_CHUNK_DOCS, max_chunk_bytes=BULK_CHUNK_BYTES,
+                                        index=index_name, doc_type='appcompat')
+            else:
+                results = streaming_bulk(es, docs,
+                                         chunk_size=BULK_CHUNK_DOCS, max_chunk_bytes=BULK_CHUNK_BYTES,
+                                         index=index_name, doc_type='appcompat')
 
-            actions.append(action)
+            # the helpers are lazy, errors are raised while consuming the results
+            for ok, result in results:
+                pass
 
-    if len(actions) > 0:
-        bulk(es, actions)
\ No newline at end of file
+        progress.indexed(sum(i['hostname'].nunique() for i in batch), counts['rows'])
+        release_hosts(hosts)
+    finally:
+        progress.release(job_id)
@@ -1,12 +1,25 @@
 import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import numpy as np
 import pandas as pd
 import re
 from rq import Queue
 from redis import Redis
-from host_process import host_process
+from host_process import host_process, local_process
+from spool import spool_hosts, join_hosts
+from path_hosts import SqlitePathHosts, RedisPathHosts
+from metrics import Metrics, hosts_bytes
+from progress import Progress
+from model_registry import ModelRegistry
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import *
 from elasticsearch.client import IndicesClient
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 import argparse
 
 CONFIG = {
@@ -27,6 +40,10 @@ CONFIG = {
                     'index': 'not_analyzed',
                     'null_value': 0.0             
                 },
+                'model_version': {
+                    'type': 'string',
+                    'index': 'not_analyzed'
+                },
                 'hostname': {
                     'type': 'string',
                     'index': 'not_analyzed'
@@ -154,18 +171,203 @@ CONFIG = {
     }
 }
 
-# create a run order for all hosts i.e. maintain appcompat order
-def create_run_order(val):
-    val['run_order'] = range(len(val))
-    return val
+CSV_COLUMNS = ['hostname','last_modified','last_execution','path','file_size','file_executed','key_path']
+DATE_COLUMNS = ['last_modified','last_execution']
+DATE_FORMAT = '%m/%d/%y %H:%M:%S'
+
+# flow control defaults, jobs on a queue and bytes of batches queued but not finished
+MAX_QUEUED_JOBS = 100
+MAX_INFLIGHT_BYTES = 1024 * 1024 * 1024
+# how long to wait with nothing queued before deciding the bytes in flight are wrong
+STALL_SECONDS = 300
+
+# parse the timestamps, appcompat repeats the same timestamps a lot so each distinct value is only parsed once
+# malformed values become NaT rather than falling back to parsing row by row
+def parse_dates(values, date_format=DATE_FORMAT):
+    codes, uniques = pd.factorize(values)
+    # a column with no dates at all, there is nothing to take from
+    if len(uniques) == 0:
+        return pd.Series(np.full(len(values), np.datetime64('NaT'), dtype='datetime64[ns]'), index=values.index)
+    parsed = pd.to_datetime(uniques, format=date_format, errors='coerce').values
+    dates = parsed.take(codes)
+    dates[codes < 0] = np.datetime64('NaT')
+    return pd.Series(dates, index=values.index)
+
+# \??\c:\Test\blah.exe -> c:\Test\blah.exe, unc\vmware-host\... -> \\vmware-host\...
+# a path can be both i.e. unc??\c:\... (the unc is rewritten first, then the \??\ is removed)
+PATH_PREFIX = re.compile(r'^(?:unc\?\?\\|\\\?\?\\|(unc))')
+
+def rewrite_path_prefix(match):
+    return '\\' if match.group(1) else ''
+
+# normalise the paths so the same file is stacked across hosts
+# the work is done once per distinct path in one pass and the result is a categorical (one copy of each path)
+def normalize_path(path):
+    codes, uniques = pd.factorize(path)
+    uniques = [PATH_PREFIX.sub(rewrite_path_prefix, i.lower(), 1) for i in uniques]
+
+    # different paths can normalise to the same path
+    normalized_codes, normalized = pd.factorize(uniques)
+    codes = np.where(codes >= 0, normalized_codes[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, normalized), index=path.index)
+
+'''
+Normalise a frame of complete hosts read from the CSV, ready for feature extraction
+Drops corrupted rows, parses the dates, adds the run order of each host (the rows of a host are
+together and in appcompat order) and dictionary encodes the strings
+'''
+def normalize_chunk(df):
+    # filter out missing hostname or path which are likely corrupted rows
+    df = df[df.hostname.notnull() & df.path.notnull()].copy()
+
+    for i in DATE_COLUMNS:
+        df[i] = parse_dates(df[i])
+
+    # create run order per host i.e. maintain appcompat order
+    df['run_order'] = df.groupby('hostname', sort=False).cumcount()
+
+    # dictionary encode the strings, hostnames and paths are repeated a lot
+    df['hostname'] = df['hostname'].astype('category')
+    df['path'] = normalize_path(df['path'])
+
+    # nullable integer sizes (anything that isn't a whole number is corrupt)
+    file_size = pd.to_numeric(df['file_size'], errors='coerce')
+    df['file_size'] = file_size.where(file_size == file_size.round()).astype('Int64')
+
+    # map Yes/No to True/False, unknown values stay missing
+    file_executed = df['file_executed'].map({'True': True, 'Yes': True, 'False': False, 'No': False})
+    df['file_executed'] = pd.Categorical(file_executed, categories=[False, True])
+    return df
+
+# the row where each host starts in a frame of complete hosts
+def host_starts(df):
+    hostname = df['hostname'].cat.codes.values
+    new_host = np.ones(len(hostname), dtype=bool)
+    new_host[1:] = hostname[1:] != hostname[:-1]
+    return np.flatnonzero(new_host)
+
+# count how many hosts each path has been seen on over the whole file, before any features are extracted
+def count_path_hosts(path_hosts, input_file, compression, chunk_size):
+    chunk_iter = pd.read_csv(input_file, compression=compression,
+                             names=CSV_COLUMNS,
+                             usecols=['hostname','path'],
+                             header=0,
+                             dtype=object,
+                             chunksize=chunk_size)
+    for df in chunk_iter:
+        df = df[df.hostname.notnull() & df.path.notnull()]
+        path_hosts.add(normalize_path(df['path']), df['hostname'])
+
+'''
+Rows of a host being read, the host may carry on into the next chunk
+The pieces are only joined once the host is complete, rather than concatenated again for every chunk.
+A host is extracted as one frame by one job, so the loader and the worker both hold the whole host.
+'''
+class PendingHost(object):
+    def __init__(self):
+        self.pieces = []
+        self.hostname = None
 
-# since the chunk might be in the middle of a host, we need to find the end of the last full host
-def last_host_idx(df):
-    h1 = df.iloc[-1].hostname
-    for idx in reversed(df.index):
-        h2 = df.hostname[idx]
-        if h2 != h1:
-            return idx
+    def __len__(self):
+        return len(self.pieces)
+
+    def add(self, piece):
+        if len(piece) == 0:
+            return
+        self.pieces.append(piece)
+        hostname = piece['hostname'].dropna()
+        if len(hostname):
+            self.hostname = hostname.values[-1]
+
+    def pop(self):
+        pieces = self.pieces
+        self.pieces = []
+        return pieces
+
+'''
+Read the CSV chunks as frames of complete hosts, the rows of a host have to be together in the file
+Host boundaries are found with numpy, and the hosts that are complete within a chunk are yielded
+as a slice of it. A host that carries on over the end of a chunk is yielded as a frame of its own
+once it's complete. With join_carried it's joined to the hosts that are complete in the next chunk
+instead, and the last host to the frame before it, so every frame has about a chunk of hosts like
+--path_hosts chunk expects. That copies almost every chunk, so it's only done for chunk.
+'''
+def iter_host_chunks(chunk_iter, join_carried=False):
+    pending = PendingHost()
+    # held back until the next chunk is read, in case the last host has to go with it
+    frame = None
+    for chunk in chunk_iter:
+        if len(chunk) == 0:
+            continue
+
+        # the rows where a new host starts, corrupted rows without a hostname stay with the host they're in
+        hostname = chunk['hostname'].fillna(method='ffill')
+        if pending.hostname is not None:
+            hostname = hostname.fillna(pending.hostname)
+        hostname = hostname.values
+        starts = np.flatnonzero(hostname[1:] != hostname[:-1]) + 1
+        if not len(pending) or pending.hostname != hostname[0]:
+            starts = np.insert(starts, 0, 0)
+
+        # the whole chunk belongs to the host we're already reading
+        if not len(starts):
+            pending.add(chunk)
+            continue
+
+        # the rest of the pending host and the hosts that are complete within this chunk
+        complete = chunk.iloc[starts[0]:starts[-1]]
+        if len(pending):
+            pending.add(chunk.iloc[:starts[0]])
+            if join_carried:
+                complete = pd.concat(pending.pop() + [complete])
+            else:
+                yield pd.concat(pending.pop())
+        if len(complete):
+            if join_carried:
+                if frame is not None:
+                    yield frame
+                frame = complete
+            else:
+                yield complete
+
+        # the last host may carry on into the next chunk
+        pending.add(chunk.iloc[starts[-1]:])
+
+    if len(pending):
+        if join_carried:
+            frame = pd.concat(([frame] if frame is not None else []) + pending.pop())
+        else:
+            yield pd.concat(pending.pop())
+    if frame is not None:
+        yield frame
+
+'''
+Pause while the workers catch up, so the loader doesn't fill Redis faster than they can empty it
+If nothing is queued but the bytes in flight stay over the limit, a worker must have died holding
+a batch, so give up waiting on it rather than wait forever
+'''
+def wait_for_workers(q, high_q, progress):
+    waited = 0
+    delay = 0.1
+    while progress.over_limit(q):
+        if waited > STALL_SECONDS and q.count == 0 and high_q.count == 0:
+            logging.warning('Queues are empty but the batches in flight are over the limit, carrying on')
+            break
+        if not waited:
+            logging.debug('Waiting for the workers to catch up...')
+            progress.set_state('waiting')
+        time.sleep(delay)
+        waited += delay
+        delay = min(delay * 2, 5)
+    if waited:
+        progress.set_state('reading')
+
+# wait for the local workers, raising any of their errors and adding up the metrics they kept
+def wait_futures(futures, metrics, return_when=ALL_COMPLETED):
+    done, _ = wait(futures, return_when=return_when)
+    for future in done:
+        futures.remove(future)
+        metrics.merge(future.result())
 
 # setup the elastic search index
 def create_es_index(index_name):
@@ -191,8 +393,17 @@ def main():
     group.add_argument("read_file", help="Reads data from a file")
     group.add_argument("index_name", help="Elasticsearch index name (prepended with 'appcompat')")
     
-    group.add_argument("--chunk_size", help="Set the size of the chunks, where bigger chunks use more memory, but too small with impact unique host features. Default is 250000.")
+    group.add_argument("--chunk_size", type=int, help="Set the size of the chunks, where bigger chunks use more memory (with --path_hosts chunk, too small will impact unique host features). Default is 250000.")
     group.add_argument("--compression", help="Input CSV file is compressed (uses Pandas method {'infer', 'gzip', 'bz2'})")
+    group.add_argument("--path_hosts", choices=['sqlite','redis','hll','chunk'], default='sqlite',
+                       help="How f_path_unique_hosts is counted: exactly over the whole file in sqlite (default), exactly over all ingests in redis, approximately over all ingests with a redis HyperLogLog, or per chunk")
+    group.add_argument("--path_hosts_db", help="sqlite database for --path_hosts sqlite, keep it to count over several ingests (default is a temporary file)")
+    group.add_argument("--local", action="store_true", help="Extract features and load into Elasticsearch with a local process pool instead of Redis/rq workers")
+    group.add_argument("--workers", type=int, help="Number of processes for --local. Default is the number of CPUs.")
+    group.add_argument("--spool_dir", help="Pass batches to the workers as Arrow files in this directory instead of through Redis (must be shared with the workers, requires pyarrow)")
+    group.add_argument("--max_queued_jobs", type=int, default=MAX_QUEUED_JOBS, help="Pause reading while this many jobs are waiting on a queue (0 for no limit). Default is {}.".format(MAX_QUEUED_JOBS))
+    group.add_argument("--max_inflight_bytes", type=int, default=MAX_INFLIGHT_BYTES, help="Pause reading while batches of this many bytes are queued but not finished (0 for no limit). Default is 1GB.")
+    group.add_argument("--score", action="store_true", help="Score the entries with the current model as they're loaded, rather than waiting for a reprocess (requires scikit-learn on the workers)")
     
     
     args = parser.parse_args()
@@ -215,88 +426,146 @@ def main():
     else:
         compression = None
 
+    spool_dir = None
+    if args.spool_dir:
+        # the workers may run from another directory
+        spool_dir = os.path.abspath(args.spool_dir)
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+
     logging.info('Creating elasticsearch index...')
     create_es_index(index_name)
 
 
     logging.info('Reading CSV...')
     chunk_iter = pd.read_csv(input_file, compression=compression, 
-                             names=['hostname','last_modified','last_execution','path','file_size','file_executed','key_path'],
+                             names=CSV_COLUMNS,
                              usecols=['hostname','last_modified','last_execution','path','file_size','file_executed'], 
                              header=0,
-                             dtype=object, parse_dates=['last_modified','last_execution'], 
-                             date_parser=lambda x: pd.to_datetime(x, format="%m/%d/%y %H:%M:%S"), 
+                             dtype=object,
                              chunksize=CHUNKSIZE)
 
     # Tell RQ what Redis connection to use
     redis_conn = Redis()
     q = Queue(connection=redis_conn)  # no args implies the default queue
+    high_q = Queue('high', connection=redis_conn)
+    metrics = Metrics(redis_conn)
+    progress = Progress(redis_conn, index_name)
+    progress.start(args.max_queued_jobs, args.max_inflight_bytes)
 
-    # iterable, but need to convert to iterator
-    chunk_iter = iter(chunk_iter)
-
-    more_chunks = True
-    df = next(chunk_iter, None)
-    while (more_chunks):
-        # keep future chunk to check if we're at the end
-        next_chunk = next(chunk_iter, None)
-
-        # in order to prevent very small chunks, combine the last chunk with the second last chunk
-        if next_chunk is None:
-            more_chunks = False
-        elif len(next_chunk) < CHUNKSIZE:
-            df = pd.concat([df, next_chunk], ignore_index=True)
-            more_chunks = False
-        # otherwise, chop off the last hostname rows and append to next chunk
-        else:
-            idx = last_host_idx(df)
-            last_host = df[idx+1:]
-            df = df[:idx]
-            next_chunk = pd.concat([last_host, next_chunk], ignore_index=True)
+    # every batch is scored with the same model, even if another is registered during the ingest
+    model_version = None
+    if args.score:
+        model_version = ModelRegistry(redis_conn).current()
+        if model_version is None:
+            logging.warning('No model has been registered yet, the entries will be scored by the next reprocess')
 
-        # filter out missing hostname or path which are likely corrupted rows  
-        df = df[df.hostname.notnull() & df.path.notnull()]
+    path_hosts = None
+    tmp_dir = None
+    if args.path_hosts == 'sqlite':
+        db_path = args.path_hosts_db
+        if not db_path:
+            tmp_dir = tempfile.mkdtemp()
+            db_path = os.path.join(tmp_dir, 'path_hosts.db')
+        path_hosts = SqlitePathHosts(db_path)
+    elif args.path_hosts in ['redis','hll']:
+        path_hosts = RedisPathHosts(redis_conn, approximate=args.path_hosts == 'hll')
+
+    if path_hosts:
+        logging.info('Counting hosts per path...')
+        count_path_hosts(path_hosts, input_file, compression, CHUNKSIZE)
 
-        # create run order per host    
-        df = df.groupby('hostname').apply(create_run_order)
+    # run the workers locally rather than through rq
+    futures = set()
+    if args.local:
+        workers = args.workers or multiprocessing.cpu_count()
+        executor = ProcessPoolExecutor(max_workers=workers)
 
-        # map Yes/No to True/False
-        df['file_executed'] = df['file_executed'].map({'True': True, 'Yes': True, 'False': False, 'No': False})
+    def enqueue_hosts(hosts):
+        rows = sum(len(i) for i in hosts)
+        host_count = sum(len(host_starts(i)) for i in hosts)
+        with metrics.timed(index_name, 'queue', rows=rows) as counts:
+            if args.local:
+                # bounded queue, so the reader doesn't get too far ahead of the workers
+                while len(futures) >= workers * 2:
+                    wait_futures(futures, metrics, FIRST_COMPLETED)
+                payload = join_hosts(hosts)
+                counts['bytes'] = hosts_bytes(payload)
+                futures.add(executor.submit(local_process, index_name, payload, model_version))
+                progress.queued(host_count, rows)
+                return
 
-        # convert path to lowercase
-        df['path'] = df['path'].str.lower()
+            wait_for_workers(q, high_q, progress)
 
-        # convert UNC\vmware-host\Shared Folders\Test\blah.exe -> \\host\vmware-host\...
-        df['path'] = df['path'].str.replace(r'^unc', '\\\\', 1)
+            logging.debug('Loading batch into Redis queue (size: {})...'.format(len(hosts)))
+            # only a path to the batch goes through redis when spooling
+            if spool_dir:
+                payload = spool_hosts(hosts, spool_dir)
+                counts['bytes'] = os.path.getsize(payload)
+            else:
+                payload = join_hosts(hosts)
+                counts['bytes'] = hosts_bytes(payload)
 
-        # remove \??\ from \??\c:\Test\blah.exe
-        df['path'] = df['path'].str.replace(r'^{}'.format(re.escape('\\??\\')), '', 1)
+            # counted as in flight before it's queued, in case it's finished before we get back
+            job_id = str(uuid.uuid4())
+            progress.queued(host_count, rows, job_id, counts['bytes'])
+            q.enqueue(host_process, index_name, payload, spool_dir, model_version, job_id=job_id)
 
-        # calculate many hosts this path has been seen 
-        grp_path = df.groupby('path')
-        df_tmp = grp_path['hostname'].nunique().reset_index()
-        df_tmp.columns = ['path','f_path_unique_hosts']
-        df = pd.merge(df, df_tmp, how='left', on=['path'])
+    # Break up into smaller batches to distribute across availables workers
+    BATCHSIZE = 50
+    result_hosts = []
+    result_count = 0
 
-        # Break up into smaller batches to distribute across availables workers
-        BATCHSIZE = 50
-        
-        hosts = df.groupby('hostname')
+    read_start = time.time()
+    for df in iter_host_chunks(chunk_iter, join_carried=args.path_hosts == 'chunk'):
+        # the read stage includes reading the chunk from the CSV
+        with metrics.timed(index_name, 'read', start=read_start) as counts:
+            df = normalize_chunk(df)
 
-        result_hosts = []
-        for hostname, host_data in hosts:
-            # batch up results and submit to queue
-            result_hosts.append(host_data)
-            if len(result_hosts) >= BATCHSIZE:
-                logging.debug('Loading batch into Redis queue (size: {})...'.format(len(result_hosts)))
-                q.enqueue(host_process, index_name, result_hosts)
+            # calculate many hosts this path has been seen 
+            if path_hosts:
+                df['f_path_unique_hosts'] = path_hosts.counts(df['path'])
+            else:
+                grp_path = df.groupby('path', observed=True)
+                df_tmp = grp_path['hostname'].nunique().reset_index()
+                df_tmp.columns = ['path','f_path_unique_hosts']
+                df = pd.merge(df, df_tmp, how='left', on=['path'])
+            counts['rows'] = len(df)
+
+        # batch up results and submit to queue, the rows of each host are together so batches are slices of the frame
+        starts = host_starts(df)
+        i = 0
+        while i < len(starts):
+            n = min(BATCHSIZE - result_count, len(starts) - i)
+            end = starts[i + n] if i + n < len(starts) else len(df)
+            result_hosts.append(df.iloc[starts[i]:end])
+            result_count += n
+            i += n
+            if result_count >= BATCHSIZE:
+                enqueue_hosts(result_hosts)
                 result_hosts = []
-        if len(result_hosts) > 0:
-            logging.debug('Loading batch into Redis queue (size: {})...'.format(len(result_hosts)))
-            q.enqueue(host_process, index_name, result_hosts)
+                result_count = 0
+        read_start = time.time()
+
+    if len(result_hosts) > 0:
+        enqueue_hosts(result_hosts)
+
+    # the size of the CSV as read
+    metrics.record(index_name, 'read', bytes=os.path.getsize(input_file), jobs=0)
+    progress.set_state('queued')
+
+    if args.local:
+        logging.info('Waiting for local workers...')
+        wait_futures(futures, metrics)
+        executor.shutdown()
+
+    for stage, values in sorted(metrics.read(index_name).items()):
+        logging.info('{}: {:.0f} rows, {:.0f} bytes, {:.1f}s, {:.0f} errors'.format(stage, values['rows'], values['bytes'], values['seconds'], values['errors']))
 
-        # process the next chunk
-        df = next_chunk
+    if path_hosts:
+        path_hosts.close()
+    if tmp_dir:
+        shutil.rmtree(tmp_dir)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
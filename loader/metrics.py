@@ -0,0 +1,94 @@
+import time
+from contextlib import contextmanager
+from redis.exceptions import RedisError
+
+'''
+Per stage metrics for each ingest, so we can see where the time goes
+Each stage adds its rows, bytes, wall time, errors and jobs to a Redis hash per index and stage
+(metrics:<index>:<stage>), along with when the stage was first and last seen. The web interface
+reads these for /api/metrics. There is one pipelined round trip per job, nothing is done per row.
+When Redis isn't available the metrics are kept on the Metrics object instead.
+
+Stages:
+* read - reading and normalising the CSV in the loader
+* queue - handing batches of hosts to the workers
+* extract - feature extraction in host_process
+* load - bulk loading into Elasticsearch
+* predict - scoring in predict_data
+'''
+
+METRICS_PREFIX = 'metrics:'
+# keep the metrics of old ingests for a week
+METRICS_TTL = 7 * 24 * 3600
+COUNTERS = ['rows', 'bytes', 'errors', 'jobs']
+
+def metrics_key(index_name, stage):
+    return '{}{}:{}'.format(METRICS_PREFIX, index_name, stage)
+
+# in memory size of a list of host frames, without looking inside the strings (deep would measure
+# every category and object string of every batch), so object columns count a pointer per row
+def hosts_bytes(hosts):
+    return int(sum(host.memory_usage(index=True, deep=False).sum() for host in hosts))
+
+class Metrics(object):
+    def __init__(self, redis_conn=None):
+        self.redis = redis_conn
+        # stand-in for Redis, {(index_name, stage): {field: value}}
+        self.local = {}
+
+    def record(self, index_name, stage, rows=0, bytes=0, seconds=0.0, errors=0, jobs=1):
+        values = {'rows': rows, 'bytes': bytes, 'seconds': seconds, 'errors': errors, 'jobs': jobs}
+        now = time.time()
+
+        if self.redis is not None:
+            key = metrics_key(index_name, stage)
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.sadd(METRICS_PREFIX + 'indices', index_name)
+                for field in COUNTERS:
+                    pipe.hincrby(key, field, int(values[field]))
+                pipe.hincrbyfloat(key, 'seconds', seconds)
+                pipe.hsetnx(key, 'first', now)
+                pipe.hset(key, 'last', now)
+                pipe.expire(key, METRICS_TTL)
+                pipe.execute()
+                return
+            except RedisError:
+                # metrics must never fail the ingest, keep them here from now on
+                self.redis = None
+
+        metrics = self.local.setdefault((index_name, stage), {'first': now})
+        for field, value in values.items():
+            metrics[field] = metrics.get(field, 0) + value
+        metrics['last'] = now
+
+    # add the local metrics passed back from another process
+    def merge(self, metrics):
+        for (index_name, stage), values in metrics.items():
+            self.record(index_name, stage, **dict((i, values.get(i, 0)) for i in COUNTERS + ['seconds']))
+
+    '''
+    Time a stage, the rows and bytes can be set on the yielded dict once they're known
+    A stage that raises is recorded as an error, start is for stages that began earlier
+    '''
+    @contextmanager
+    def timed(self, index_name, stage, rows=0, bytes=0, start=None):
+        counts = {'rows': rows, 'bytes': bytes}
+        start = start or time.time()
+        try:
+            yield counts
+        except Exception:
+            self.record(index_name, stage, counts['rows'], counts['bytes'], time.time() - start, errors=1)
+            raise
+        self.record(index_name, stage, counts['rows'], counts['bytes'], time.time() - start)
+
+    # the metrics of each stage for an index
+    def read(self, index_name):
+        if self.redis is None:
+            return dict((stage, values) for (index, stage), values in self.local.items() if index == index_name)
+
+        result = {}
+        for key in self.redis.keys(metrics_key(index_name, '*')):
+            values = self.redis.hgetall(key)
+            result[key.rsplit(':', 1)[-1]] = dict((field, float(value)) for field, value in values.items())
+        return result
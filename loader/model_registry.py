@@ -0,0 +1,141 @@
+import cPickle as pickle
+import hashlib
+import os
+import zlib
+from collections import OrderedDict
+from forest import Forest
+
+'''
+Registry of trained models, so jobs only need to carry the model version
+Each model is pickled and stored once under the sha1 of the pickle (its version), in Redis or in a
+directory shared by the workers. Workers keep the last few models they've loaded, so a model is
+only fetched and unpickled once per process. That needs workers that don't fork a new process for
+each job i.e. rq worker -w rq.SimpleWorker.
+
+The forest is also kept flattened into arrays (forest.py), which load without unpickling. In a
+model directory the arrays are memory mapped, so every worker on a machine shares one copy. The
+workers still score with the classifier, as scoring the arrays in NumPy is about 3x slower.
+
+Redis values are limited to 512MB, use a model directory for forests bigger than that.
+'''
+
+MODEL_PREFIX = 'model:'
+# a directory shared by the workers to keep the models on disk instead of in Redis, from the
+# environment so the loader and every worker use the same one. A relative path is under the
+# working directory of each process, without it the models are kept in Redis
+MODEL_DIR = os.environ.get('APPCOMPAT_MODEL_DIR') or None
+# number of models kept loaded in each process
+MODEL_CACHE_SIZE = 2
+
+# models loaded in this process, least recently used first
+model_cache = OrderedDict()
+
+class ModelRegistry(object):
+    def __init__(self, redis_conn, model_dir=MODEL_DIR):
+        self.redis = redis_conn
+        self.model_dir = os.path.abspath(model_dir) if model_dir else None
+
+    def model_path(self, name):
+        return os.path.join(self.model_dir, name)
+
+    # store a model if it isn't already and make it the current model, returns its version
+    def register(self, clf):
+        data = pickle.dumps(clf, pickle.HIGHEST_PROTOCOL)
+        version = hashlib.sha1(data).hexdigest()
+        data = zlib.compress(data, 1)
+
+        if self.model_dir:
+            if not os.path.isdir(self.model_dir):
+                os.makedirs(self.model_dir)
+            path = self.model_path('{}.model'.format(version))
+            if not os.path.exists(path):
+                # write to a temporary name first, so a worker never sees a partial model
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.rename(path + '.tmp', path)
+            with open(self.model_path('current.tmp'), 'w') as f:
+                f.write(version)
+            os.rename(self.model_path('current.tmp'), self.model_path('current'))
+        else:
+            self.redis.set(MODEL_PREFIX + version, data, nx=True)
+            self.redis.set(MODEL_PREFIX + 'current', version)
+
+        self.store_forest(version, Forest.from_classifier(clf))
+
+        model_cache[version] = clf
+        trim_model_cache()
+        return version
+
+    def store_forest(self, version, forest):
+        if self.model_dir:
+            path = self.model_path('{}.forest'.format(version))
+            if not os.path.exists(path):
+                forest.save(path)
+        else:
+            self.redis.set('{}{}:forest'.format(MODEL_PREFIX, version), zlib.compress(forest.to_bytes(), 1), nx=True)
+
+    # the version of the last registered model
+    def current(self):
+        if self.model_dir:
+            path = self.model_path('current')
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                return f.read().strip()
+        return self.redis.get(MODEL_PREFIX + 'current')
+
+    def load(self, version):
+        if version in model_cache:
+            clf = model_cache.pop(version)
+            model_cache[version] = clf
+            return clf
+
+        if self.model_dir:
+            path = self.model_path('{}.model'.format(version))
+            data = open(path, 'rb').read() if os.path.exists(path) else None
+        else:
+            data = self.redis.get(MODEL_PREFIX + version)
+        if data is None:
+            raise Exception('Model not found: {}'.format(version))
+
+        data = zlib.decompress(data)
+        if hashlib.sha1(data).hexdigest() != version:
+            raise Exception('Model is corrupt: {}'.format(version))
+
+        clf = pickle.loads(data)
+        model_cache[version] = clf
+        trim_model_cache()
+        return clf
+
+    '''
+    The flattened forest of a model, built from the pickled model the first time for models that
+    were registered without one
+    '''
+    def load_forest(self, version):
+        key = version + ':forest'
+        if key in model_cache:
+            forest = model_cache.pop(key)
+            model_cache[key] = forest
+            return forest
+
+        forest = None
+        if self.model_dir:
+            path = self.model_path('{}.forest'.format(version))
+            if os.path.exists(path):
+                forest = Forest.load(path)
+        else:
+            data = self.redis.get('{}{}:forest'.format(MODEL_PREFIX, version))
+            if data is not None:
+                forest = Forest.from_bytes(zlib.decompress(data))
+
+        if forest is None:
+            self.store_forest(version, Forest.from_classifier(self.load(version)))
+            return self.load_forest(version)
+
+        model_cache[key] = forest
+        trim_model_cache()
+        return forest
+
+def trim_model_cache():
+    while len(model_cache) > MODEL_CACHE_SIZE:
+        model_cache.popitem(last=False)
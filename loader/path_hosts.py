@@ -0,0 +1,84 @@
+import sqlite3
+import pandas as pd
+
+'''
+Global path to host cardinality for f_path_unique_hosts
+The loader adds every (path, hostname) pair in the file before extracting features, so the
+counts are correct over the whole file rather than just the chunk. The counts are kept outside
+of the loader's memory, so the chunk size no longer changes the feature values.
+'''
+
+# number of keys per redis pipeline / sqlite query
+LOOKUP_BATCHSIZE = 500
+
+def unique_pairs(paths, hostnames):
+    return pd.DataFrame({'path': paths.values, 'hostname': hostnames.values}).drop_duplicates()
+
+'''
+Exact counts kept in an on-disk sqlite table
+Memory use is bounded by sqlite's cache, pass the same db file to count over all ingests
+'''
+class SqlitePathHosts(object):
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS path_hosts (path TEXT, hostname TEXT, PRIMARY KEY (path, hostname))')
+
+    def add(self, paths, hostnames):
+        pairs = unique_pairs(paths, hostnames)
+        self.conn.executemany('INSERT OR IGNORE INTO path_hosts VALUES (?, ?)', pairs[['path','hostname']].itertuples(index=False))
+        self.conn.commit()
+
+    def counts(self, paths):
+        paths = paths.astype(object)
+        uniques = paths.unique()
+        counts = {}
+        for i in range(0, len(uniques), LOOKUP_BATCHSIZE):
+            keys = list(uniques[i:i+LOOKUP_BATCHSIZE])
+            query = 'SELECT path, COUNT(*) FROM path_hosts WHERE path IN ({}) GROUP BY path'.format(','.join('?' * len(keys)))
+            counts.update(self.conn.execute(query, keys))
+        return paths.map(counts).fillna(0).astype(int)
+
+    def close(self):
+        self.conn.close()
+
+'''
+Counts kept in redis, shared by every ingest using the same redis server
+Exact counts use a set per path, approximate counts use a HyperLogLog per path which uses
+at most 12KB per path with a standard error of 0.81% (fixed by redis)
+'''
+class RedisPathHosts(object):
+    def __init__(self, redis_conn, approximate=False, prefix='path_hosts:'):
+        self.redis = redis_conn
+        self.approximate = approximate
+        self.prefix = prefix
+
+    def add(self, paths, hostnames):
+        pairs = unique_pairs(paths, hostnames)
+        pipe = self.redis.pipeline(transaction=False)
+        for n, (path, hosts) in enumerate(pairs.groupby('path', observed=True)['hostname']):
+            if self.approximate:
+                pipe.pfadd(self.prefix + path, *hosts.tolist())
+            else:
+                pipe.sadd(self.prefix + path, *hosts.tolist())
+            if n % LOOKUP_BATCHSIZE == LOOKUP_BATCHSIZE - 1:
+                pipe.execute()
+        pipe.execute()
+
+    def counts(self, paths):
+        paths = paths.astype(object)
+        uniques = paths.unique()
+        counts = {}
+        for i in range(0, len(uniques), LOOKUP_BATCHSIZE):
+            keys = uniques[i:i+LOOKUP_BATCHSIZE]
+            pipe = self.redis.pipeline(transaction=False)
+            for path in keys:
+                if self.approximate:
+                    pipe.pfcount(self.prefix + path)
+                else:
+                    pipe.scard(self.prefix + path)
+            counts.update(zip(keys, pipe.execute()))
+        return paths.map(counts).fillna(0).astype(int)
+
+    def close(self):
+        pass
@@ -1,10 +1,19 @@
 from sklearn.ensemble import ExtraTreesClassifier
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import scan, bulk
-from rq import Queue
+from rq import Queue, get_current_job
 from redis import Redis
+import heapq
 import os
-import pickle
+import numpy as np
+from itertools import islice
+import time
+import uuid
+from collections import Counter
+from metrics import Metrics
+from model_registry import ModelRegistry
+from rescore_coverage import RescoreCoverage
+from training_store import TrainingStore, TRAINING_LABELS, feature_matrix
 
 es = Elasticsearch()
 columns = [
@@ -27,57 +36,60 @@ columns = [
     'f_users_dir'
 ]
 
-def train(index_name):
-    data = []
-    labels = []
+'''
+Fetch the feature columns of every document matching a query as a float32 matrix
+Scrolls through all of the matches rather than stopping at a page, and only the feature columns
+are sent back. size stops after that many documents, which needs preserve_order for a sorted query.
+'''
+def fetch_features(index_name, query, size=None, **kwargs):
+    hits = scan(es, index=index_name, doc_type='appcompat', query={'query': query, '_source': columns}, **kwargs)
+    if size is not None:
+        hits = islice(hits, size)
 
-    # setup the training data with features and consistent structure        
+    return feature_matrix([hit['_source'] for hit in hits], columns)
 
-    # get all evil labeled data from the training set
-    query = {'bool': {
-            'filter': [
-                {'term': {'class_label': 'evil'} }
-            ]
-        }
-    }
-    result = es.search(body={'query':query}, index="appcompat-training", doc_type="appcompat", size=1024)
+'''
+The store of labelled training entries, built from appcompat-training the first time
+'''
+def training_store(redis_conn):
+    store = TrainingStore(redis_conn, columns)
+    if not store.built():
+        query = {'bool': {'filter': [{'terms': {'class_label': TRAINING_LABELS}}]}}
+        hits = scan(es, index='appcompat-training', doc_type='appcompat', query={'query': query, '_source': columns + ['class_label']})
+        store.build((hit['_id'], hit['_source']['class_label'], hit['_source']) for hit in hits)
+    return store
 
-    rows = []
-    for i in result['hits']['hits']:
-        row = []
-        for j in columns:
-            row.append(i['_source'][j])
-        rows.append(row)
-    data.extend(rows)
-    num_evil = len(rows)
-
-    # label these rows as "1 == evil"
-    labels.extend([1]*num_evil)
-
-    # get all non_evil labeled data from the training set
-    query = {'bool': {
-            'filter': [
-                {'term': {'class_label': 'not_evil'} }
-            ]
-        }
-    }
-    result = es.search(body={'query':query}, index="appcompat-training", doc_type="appcompat", size=1024*3)
+'''
+Copy the labels and features of entries from appcompat-training to the training store, queued by
+the web interface when entries are labelled. Removes the entries that are no longer there.
+'''
+def sync_training_entries(entry_ids):
+    store = TrainingStore(Redis(), columns)
+    # the whole store is built by the next reprocess
+    if not store.built():
+        return
 
-    # setup the training data with features and consistent structure        
-    rows = []
-    for i in result['hits']['hits']:
-        row = []
-        for j in columns:
-            row.append(i['_source'][j])
-        rows.append(row)
-    data.extend(rows)
-    num_not_evil = len(rows)
+    result = es.mget(index='appcompat-training', doc_type='appcompat', body={'ids': list(entry_ids)}, _source=columns + ['class_label'])
+    for doc in result['docs']:
+        if doc.get('found'):
+            store.update(doc['_id'], doc['_source']['class_label'], doc['_source'])
+        else:
+            store.update(doc['_id'])
 
-    # label these rows as "0 == not_evil"
-    labels.extend([0]*num_not_evil)
+def sync_training_entry(entry_id):
+    sync_training_entries([entry_id])
+
+def train(index_name, store=None):
+    store = store or training_store(Redis())
+
+    # all evil and not_evil labeled data from the training set
+    evil = store.matrix('evil')
+    num_evil = len(evil)
+    not_evil = store.matrix('not_evil')
+    num_not_evil = len(not_evil)
 
     # Aim for a 1:3 ratio of evil to non evil
-    num_other = 0
+    other = np.empty((0, len(columns)), dtype=np.float32)
     if num_not_evil < (num_evil*3):
 
         # fill rest with random data (chances are its not evil) from index
@@ -95,74 +107,206 @@ def train(index_name):
         }
 
         size = (num_evil*3) - num_not_evil
-        result = es.search(body={'query':query}, index=index_name, doc_type="appcompat", sort='_score:asc', size=size)
-
-        # setup the training data with features and consistent structure        
-        for i in result['hits']['hits']:
-            row = []
-            for j in columns:
-                row.append(i['_source'][j])
-            rows.append(row)
-        data.extend(rows)
-        num_other = len(rows)
+        other = fetch_features(index_name, query, size=size, preserve_order=True)
+    num_other = len(other)
 
-        # label these rows as "0 == not_evil"
-        labels.extend([0]*num_other)
+    # label the rows as "1 == evil" and "0 == not_evil"
+    data = np.concatenate([evil, not_evil, other])
+    labels = np.concatenate([np.ones(num_evil, dtype=np.int8), np.zeros(num_not_evil + num_other, dtype=np.int8)])
 
     clf = ExtraTreesClassifier(n_estimators=1000, class_weight="balanced")
     clf = clf.fit(data, labels)
     print num_evil, num_not_evil, num_other
 
-    with open('randomforest.dat', 'wb') as rf_file:
-        pickle.dump(clf, rf_file)
-
     return clf
 
 BATCHSIZE = 20000
-def update_predict(index_name, full_scan=False):
-    train_clf = train(index_name)
+# skip updating a document when its score moves by less than this, by default
+PREDICT_EPSILON = 0.001
+# number of workers a full scan is split between
+PREDICT_SLICES = 8
+SLICE_TIMEOUT = 24 * 3600
+# rescoring only needs the features, the current score and the model that scored it
+rescore_source = columns + ['predict', 'model_version']
+
+'''
+Train a model and rescore the index with it
+Training is skipped when no entries have been labelled since the current model was trained.
+Scored documents record the model version that scored them. With incremental only documents
+scored by another model are rescored, which includes documents that have been loaded again since
+they were scored, as the loader writes them without a version. Scores that move by less than
+epsilon aren't written back at all. The documents keep their old version, and once the whole
+rescore has finished that version is recorded as covered by the model (rescore_coverage.py), so
+the next incremental rescore skips them too. A rescore capped at 10000 documents covers nothing.
 
+A full scan is split into slices, each read, scored and written back by its own rescore_slice job.
+The ids of the slice jobs are kept in this job's meta for /api/job_status.
+'''
+def update_predict(index_name, full_scan=False, incremental=False, epsilon=PREDICT_EPSILON, slices=None):
     redis_conn = Redis()
     q = Queue(connection=redis_conn)
+    registry = ModelRegistry(redis_conn)
+    store = training_store(redis_conn)
+
+    # the jobs only carry the model version, the workers load the model from the registry
+    # no labels have changed since the current model was trained, so it would be the same model
+    generation = store.generation()
+    model_version = registry.current()
+    if model_version is None or store.trained_version(generation) != model_version:
+        model_version = registry.register(train(index_name, store))
+        store.set_trained(generation, model_version)
+
+    coverage = RescoreCoverage(redis_conn)
+    job = get_current_job()
+    run_id = job.id if job else str(uuid.uuid4())
+
+    query = {'match_all': {}}
+    if incremental:
+        # documents scored by this model, or by a model whose scores this one has checked
+        scored = [{'term': {'model_version': model_version}}]
+        for name, versions in coverage.covered(index_name, model_version).items():
+            scored.append({'bool': {'filter': [{'term': {'_index': name}}, {'terms': {'model_version': versions}}]}})
+        query = {'bool': {'must_not': scored}}
 
     if full_scan:
-        result = scan(es, index=index_name, doc_type='appcompat', query={'query':{'match_all': {}}})
+        bodies = slice_queries(index_name, query, slices or PREDICT_SLICES)
+        # before the jobs are queued, in case they finish first
+        coverage.start(run_id, len(bodies))
+        job_ids = []
+        for body in bodies:
+            slice_job = q.enqueue_call(rescore_slice, args=(index_name, body, model_version, epsilon, run_id), timeout=SLICE_TIMEOUT)
+            job_ids.append(slice_job.id)
+
+        if job:
+            job.meta['jobs'] = job_ids
+            job.save_meta()
+        return
+
+    result = es.search(index=index_name, doc_type='appcompat', body={'query': query, '_source': rescore_source}, sort='predict:desc', size=10000)
+    hits = result['hits']['hits']
+    batches = [hits[i:i+BATCHSIZE] for i in range(0, len(hits), BATCHSIZE)]
+
+    # only a rescore that sees every match covers the versions it leaves
+    if batches and len(hits) >= result['hits']['total']:
+        coverage.start(run_id, len(batches))
     else:
-        result = es.search(index=index_name, doc_type='appcompat', body={'query':{'match_all': {}}}, sort='predict:desc', size=10000)
-        result = result['hits']['hits']
+        run_id = None
+
+    for rows in batches:
+        q.enqueue(predict_data, model_version, rows, epsilon, run_id)
+
+'''
+Split a query into slices that can be scrolled at the same time, returns a search body per slice
+Elasticsearch 5 and later have sliced scrolls. Before that the hostnames are shared out between
+the slices instead, biggest first to the slice with the fewest documents, so the slices are only
+as even as the hosts allow.
+'''
+def slice_queries(index_name, query, slices):
+    if slices <= 1:
+        return [{'query': query}]
+
+    if int(es.info()['version']['number'].split('.')[0]) >= 5:
+        return [{'query': query, 'slice': {'id': i, 'max': slices}} for i in range(slices)]
+
+    # size 0 returns every hostname
+    aggs = {'hostnames': {'terms': {'field': 'hostname', 'size': 0}}}
+    result = es.search(index=index_name, doc_type='appcompat', body={'query': query, 'aggs': aggs}, size=0)
+
+    parts = [(0, i, []) for i in range(slices)]
+    for bucket in sorted(result['aggregations']['hostnames']['buckets'], key=lambda i: -i['doc_count']):
+        count, i, hostnames = heapq.heappop(parts)
+        hostnames.append(bucket['key'])
+        heapq.heappush(parts, (count + bucket['doc_count'], i, hostnames))
 
+    return [{'query': {'bool': {'must': [query], 'filter': [{'terms': {'hostname': hostnames}}]}}}
+            for count, i, hostnames in sorted(parts, key=lambda i: i[1]) if hostnames]
+
+'''
+Rescore one slice of an index, reading, scoring and writing back in this worker
+'''
+def rescore_slice(index_name, body, model_version, epsilon=PREDICT_EPSILON, run_id=None):
+    body = dict(body, _source=rescore_source)
     rows = []
-    for i in result:
+    skipped = set()
+    for i in scan(es, index=index_name, doc_type='appcompat', query=body):
         rows.append(i)
 
-        if len(rows) > BATCHSIZE:
-            q.enqueue(predict_data, train_clf, rows)
+        if len(rows) >= BATCHSIZE:
+            skipped |= predict_data(model_version, rows, epsilon)
             rows = []
 
     if len(rows) > 0:
-        q.enqueue(predict_data, train_clf, rows)
+        skipped |= predict_data(model_version, rows, epsilon)
+
+    if run_id:
+        RescoreCoverage(Redis()).finish(run_id, model_version, skipped)
+
+'''
+Score rows and write back the scores that have moved
+model is a version in the model registry, scored with its cached classifier (or a classifier).
+With run_id the rows are a job of that rescore. Returns the (index, version) pairs of the
+documents left with an older version.
+'''
+def predict_data(model, rows, epsilon=0.0, run_id=None):
+    redis_conn = Redis()
+    metrics = Metrics(redis_conn)
+    start = time.time()
+    errors = 0
+    try:
+        model_version = None
+        if isinstance(model, basestring):
+            model_version = model
+            model = ModelRegistry(redis_conn).load(model_version)
+        skipped = score_rows(model, rows, model_version, epsilon)
+        if run_id:
+            RescoreCoverage(redis_conn).finish(run_id, model_version, skipped)
+        return skipped
+    except Exception:
+        errors = 1
+        raise
+    finally:
+        # the rows can be from several indices when scoring appcompat-*, split the time between them
+        seconds = time.time() - start
+        for index_name, count in Counter(doc['_index'] for doc in rows).items():
+            metrics.record(index_name, 'predict', rows=count, seconds=seconds * count / len(rows), errors=errors)
 
-def predict_data(clf, rows):
-    data = []
-    for doc in rows:
-        row = []
-        for i in columns:
-            row.append(doc['_source'][i])
-        data.append(row)
+'''
+Score a frame of extracted features with a model from the registry, so batches can be loaded
+already scored. Sets predict and model_version on the frame as a rescore would.
+'''
+def score_batch(batch, model_version, redis_conn=None):
+    clf = ModelRegistry(redis_conn or Redis()).load(model_version)
+    batch['predict'] = clf.predict_proba(feature_matrix(batch, columns))[:, 1]
+    batch['model_version'] = model_version
+    return batch
 
-    result = clf.predict_proba(data)
+def score_rows(clf, rows, model_version=None, epsilon=0.0):
+    result = clf.predict_proba(feature_matrix([doc['_source'] for doc in rows], columns))
 
     actions = []
+    skipped = set()
     for doc,predict in zip(rows,result):
+        # a small change in score isn't worth an update, unless no model has scored the document
+        scored_by = doc['_source'].get('model_version')
+        if epsilon and (scored_by or not model_version) and abs(predict[1] - (doc['_source'].get('predict') or 0.0)) < epsilon:
+            if scored_by and scored_by != model_version:
+                skipped.add((doc['_index'], scored_by))
+            continue
+
+        update = {'predict': predict[1]}
+        if model_version:
+            update['model_version'] = model_version
+
         action = {
             '_op_type': 'update',
             "_index": doc['_index'],
             "_type": "appcompat",
             "_id": doc['_id'],
-            "doc": {'predict': predict[1]}
+            "doc": update
         }
 
         actions.append(action)
         
     if len(actions) > 0:
         bulk(es, actions)
+    return skipped
@@ -0,0 +1,115 @@
+import time
+from redis.exceptions import RedisError
+from rq import get_current_job
+
+'''
+Progress and flow control for an ingest
+The loader, host_process and load_elastic count the hosts and rows they have queued, processed
+and indexed in a Redis hash per index (progress:<index>), which the web interface polls.
+
+The payload bytes of every queued job are kept until the job has finished with them (in flight),
+so the loader can pause while too much is waiting in Redis, and host_process can tell when the
+high queue is full. A job that fails still releases its bytes. If Redis isn't available
+the progress isn't kept and there are no limits.
+'''
+
+PROGRESS_PREFIX = 'progress:'
+# keep the progress of old ingests for a week
+PROGRESS_TTL = 7 * 24 * 3600
+
+def progress_key(index_name):
+    return '{}{}'.format(PROGRESS_PREFIX, index_name)
+
+# the id of the rq job being run, if any
+def current_job_id():
+    job = get_current_job()
+    return job.id if job else None
+
+class Progress(object):
+    def __init__(self, redis_conn, index_name):
+        self.redis = redis_conn
+        self.key = progress_key(index_name)
+        self.inflight_key = self.key + ':inflight'
+
+    def update(self, counts=None, values=None, inflight=None):
+        if self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for field, value in (counts or {}).items():
+                pipe.hincrby(self.key, field, int(value))
+            values = dict(values or {}, updated=time.time())
+            pipe.hmset(self.key, values)
+            if inflight:
+                job_id, bytes = inflight
+                pipe.hincrby(self.key, 'inflight_bytes', int(bytes))
+                pipe.hset(self.inflight_key, job_id, int(bytes))
+                pipe.expire(self.inflight_key, PROGRESS_TTL)
+            pipe.expire(self.key, PROGRESS_TTL)
+            pipe.execute()
+        except RedisError:
+            # progress must never fail the ingest
+            self.redis = None
+
+    def start(self, max_queued_jobs=None, max_inflight_bytes=None):
+        values = {'state': 'reading', 'started': time.time()}
+        # the workers check the limits too
+        if max_queued_jobs:
+            values['max_queued_jobs'] = max_queued_jobs
+        if max_inflight_bytes:
+            values['max_inflight_bytes'] = max_inflight_bytes
+        self.update(values=values)
+
+    def set_state(self, state):
+        self.update(values={'state': state})
+
+    # a batch of hosts has been queued, job_id is None when it isn't going through redis
+    def queued(self, hosts, rows, job_id=None, bytes=0):
+        self.update(counts={'hosts_queued': hosts, 'rows_queued': rows},
+                    inflight=(job_id, bytes) if job_id else None)
+
+    def processed(self, hosts, rows, job_id=None, bytes=0):
+        self.update(counts={'hosts_processed': hosts, 'rows_processed': rows},
+                    inflight=(job_id, bytes) if job_id else None)
+
+    def indexed(self, hosts, rows):
+        self.update(counts={'hosts_indexed': hosts, 'rows_indexed': rows})
+
+    # the job has finished with its payload, called whether it worked or not
+    def release(self, job_id):
+        if self.redis is None or job_id is None:
+            return
+        try:
+            bytes = self.redis.hget(self.inflight_key, job_id)
+            if bytes is not None:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.hdel(self.inflight_key, job_id)
+                pipe.hincrby(self.key, 'inflight_bytes', -int(bytes))
+                pipe.execute()
+        except RedisError:
+            self.redis = None
+
+    def read(self):
+        if self.redis is None:
+            return {}
+        try:
+            return self.redis.hgetall(self.key)
+        except RedisError:
+            self.redis = None
+            return {}
+
+    def inflight_bytes(self):
+        return int(self.read().get('inflight_bytes', 0))
+
+    '''
+    Is there too much waiting on a queue? The limits are set by the loader when the ingest starts
+    '''
+    def over_limit(self, queue):
+        progress = self.read()
+        max_queued_jobs = int(progress.get('max_queued_jobs', 0))
+        max_inflight_bytes = int(progress.get('max_inflight_bytes', 0))
+        if max_queued_jobs and queue.count >= max_queued_jobs:
+            return True
+        if max_inflight_bytes and int(progress.get('inflight_bytes', 0)) >= max_inflight_bytes:
+            return True
+        return False
@@ -0,0 +1,88 @@
+from redis import WatchError
+
+'''
+Which models' scores a rescore has checked, so a score that hasn't moved doesn't need a write
+A rescore doesn't write back a score that moves by less than epsilon, so the document keeps the
+version of the model that scored it before. Once every job of a rescore has finished, each of
+those older versions is recorded for the index as covered by the rescore's model
+(rescored:index:<index>, old version -> model version). An incremental rescore with that model
+skips the documents of covered versions as well as its own.
+
+The record only holds for documents that were there during the rescore. Scoring at ingest loads
+documents with the ingest's model version, so every batch loaded with a version removes it from
+the index's record and bumps a counter, and a rescore that sees the counter change records
+nothing. Documents loaded without a version are always rescored.
+'''
+
+COVERAGE_PREFIX = 'rescored:'
+# a rescore whose jobs don't all finish is forgotten after this long
+COVERAGE_RUN_TTL = 2 * 24 * 3600
+
+def coverage_key(*names):
+    return COVERAGE_PREFIX + ':'.join(names)
+
+class RescoreCoverage(object):
+    def __init__(self, redis_conn):
+        self.redis = redis_conn
+
+    # {index: [older versions]} covered by version, for the indices matching index_name
+    def covered(self, index_name, version):
+        result = {}
+        prefix = coverage_key('index', '')
+        for key in self.redis.scan_iter(match=prefix + index_name):
+            versions = [old for old, new in self.redis.hgetall(key).items() if new == version]
+            if versions:
+                result[key[len(prefix):]] = versions
+        return result
+
+    # documents have been written with version outside a rescore, e.g. scored at ingest
+    def scored(self, index_name, version):
+        pipe = self.redis.pipeline()
+        pipe.hdel(coverage_key('index', index_name), version)
+        pipe.incr(coverage_key('changes'))
+        pipe.execute()
+
+    # a rescore made of jobs, each of which calls finish
+    def start(self, run_id, jobs):
+        pipe = self.redis.pipeline()
+        pipe.hmset(coverage_key('run', run_id), {'jobs': jobs, 'changes': self.redis.get(coverage_key('changes')) or 0})
+        pipe.expire(coverage_key('run', run_id), COVERAGE_RUN_TTL)
+        pipe.execute()
+
+    '''
+    A job of a rescore has finished, skipped are the (index, version) pairs of the documents it
+    left with an older version. The last job records the coverage of the whole rescore.
+    Returns whether the coverage was recorded.
+    '''
+    def finish(self, run_id, version, skipped):
+        run_key = coverage_key('run', run_id)
+        skipped_key = coverage_key('run', run_id, 'skipped')
+        pipe = self.redis.pipeline()
+        if skipped:
+            pipe.sadd(skipped_key, *['{}\n{}'.format(index_name, old) for index_name, old in skipped])
+            pipe.expire(skipped_key, COVERAGE_RUN_TTL)
+        pipe.hincrby(run_key, 'jobs', -1)
+        if pipe.execute()[-1] > 0:
+            return False
+
+        covered = {}
+        for member in self.redis.smembers(skipped_key):
+            index_name, old = member.split('\n', 1)
+            covered.setdefault(index_name, {})[old] = version
+
+        try:
+            with self.redis.pipeline() as pipe:
+                # nothing may have been scored outside the rescore since it started
+                pipe.watch(coverage_key('changes'))
+                changes = pipe.get(coverage_key('changes')) or 0
+                recorded = int(changes) == int(pipe.hget(run_key, 'changes') or 0)
+                pipe.multi()
+                if recorded:
+                    for index_name, versions in covered.items():
+                        pipe.hmset(coverage_key('index', index_name), versions)
+                pipe.delete(run_key, skipped_key)
+                pipe.execute()
+        except WatchError:
+            recorded = False
+            self.redis.delete(run_key, skipped_key)
+        return recorded
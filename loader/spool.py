@@ -0,0 +1,69 @@
+import os
+import uuid
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+'''
+Local spool for passing batches of hosts between jobs
+Instead of pickling the frames into the Redis job, the batch is written to an Arrow IPC file
+in a spool directory shared by the loader and the workers, and the job only carries its path.
+Workers memory map the file, so nothing large goes through Redis.
+Requires pyarrow, which is only imported when a spool directory is used.
+'''
+
+# join a batch of hosts into one frame for a job, dropping the categories the batch doesn't use
+def join_hosts(hosts):
+    batch = pd.concat(hosts)
+    for i in hosts[0].select_dtypes(include=['category']).columns:
+        # hosts from different chunks have different categories, which concat turns into strings
+        if batch[i].dtype.name != 'category':
+            batch[i] = union_categoricals([host[i] for host in hosts])
+        batch[i] = batch[i].cat.remove_unused_categories()
+    return [batch]
+
+# write the batch to the spool and return the path to pass to the job
+def spool_hosts(hosts, spool_dir):
+    import pyarrow as pa
+
+    # categorical columns are kept, so the file gets dictionary columns
+    batch = join_hosts(hosts)[0]
+
+    # older pyarrow doesn't know about pandas' nullable integers, so pass the values and mask
+    nullable = [i for i in batch.columns if batch[i].dtype.name == 'Int64']
+    table = pa.Table.from_pandas(batch.drop(nullable, axis=1), preserve_index=False)
+    for i in nullable:
+        values = batch[i].fillna(0).astype('int64').values
+        table = table.append_column(i, pa.array(values, mask=batch[i].isna().values))
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'nullable_ints'] = ','.join(nullable).encode('utf8')
+    table = table.replace_schema_metadata(metadata)
+
+    # write to a temporary name first, so a job never sees a partial file
+    path = os.path.join(spool_dir, '{}.arrow'.format(uuid.uuid4().hex))
+    writer = pa.RecordBatchFileWriter(path + '.tmp', table.schema)
+    writer.write_table(table)
+    writer.close()
+    os.rename(path + '.tmp', path)
+    return path
+
+# jobs are given either a list of host frames or a path to a spooled batch
+def is_spooled(hosts):
+    return isinstance(hosts, str)
+
+# load the hosts for a job, reading the batch from the spool if needed
+def unspool_hosts(hosts):
+    if not is_spooled(hosts):
+        return hosts
+
+    import pyarrow as pa
+    table = pa.ipc.open_file(pa.memory_map(hosts, 'r')).read_all()
+    batch = table.to_pandas()
+    nullable = table.schema.metadata.get(b'nullable_ints', b'').decode('utf8')
+    for i in filter(None, nullable.split(',')):
+        batch[i] = batch[i].astype('Int64')
+    return [batch]
+
+# remove the spooled batch once the job has finished with it
+def release_hosts(hosts):
+    if is_spooled(hosts) and os.path.exists(hosts):
+        os.remove(hosts)
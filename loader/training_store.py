@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+'''
+The labelled training entries kept as feature rows in Redis, so a reprocess can train without
+fetching every entry from appcompat-training and building the matrix again
+The rows are float32 bytes in a hash per label (training:evil, training:not_evil) keyed by entry
+id. The web interface queues predict_data.sync_training_entry whenever an entry is labelled,
+relabelled or unlabelled, which copies the entry's label and features across. Every change bumps
+a generation counter, and the generation the current model was trained at is kept with its
+version, so a reprocess can tell nothing has changed and skip training.
+'''
+
+TRAINING_PREFIX = 'training:'
+TRAINING_LABELS = ['evil', 'not_evil']
+
+def training_key(name):
+    return '{}{}'.format(TRAINING_PREFIX, name)
+
+# the feature columns of documents' sources (or a frame) as a float32 matrix
+def feature_matrix(sources, columns):
+    # missing features are counted as 0 like the mapping's null_value
+    return pd.DataFrame(sources, columns=columns).fillna(0).values.astype(np.float32)
+
+class TrainingStore(object):
+    def __init__(self, redis_conn, columns):
+        self.redis = redis_conn
+        self.columns = columns
+
+    # built for these feature columns, a store for other columns has to be built again
+    def built(self):
+        return self.redis.get(training_key('columns')) == ','.join(self.columns)
+
+    def generation(self):
+        return int(self.redis.get(training_key('generation')) or 0)
+
+    def row(self, source):
+        return feature_matrix([source], self.columns)[0].tostring()
+
+    '''
+    Replace every entry, entries are (entry_id, label, source) with the features in source
+    '''
+    def build(self, entries):
+        entries = [i for i in entries if i[1] in TRAINING_LABELS]
+        rows = dict((label, {}) for label in TRAINING_LABELS)
+        matrix = feature_matrix([source for entry_id, label, source in entries], self.columns)
+        for (entry_id, label, source), row in zip(entries, matrix):
+            rows[label][entry_id] = row.tostring()
+
+        pipe = self.redis.pipeline()
+        for label in TRAINING_LABELS:
+            pipe.delete(training_key(label))
+            if rows[label]:
+                pipe.hmset(training_key(label), rows[label])
+        pipe.set(training_key('columns'), ','.join(self.columns))
+        pipe.incr(training_key('generation'))
+        pipe.execute()
+
+    '''
+    Store the label and features of an entry, a label that isn't trained on (or None) removes it
+    Returns whether anything changed
+    '''
+    def update(self, entry_id, label=None, source=None):
+        row = self.row(source) if label in TRAINING_LABELS else None
+        current = dict(zip(TRAINING_LABELS, [self.redis.hget(training_key(i), entry_id) for i in TRAINING_LABELS]))
+        if current == dict((i, row if i == label else None) for i in TRAINING_LABELS):
+            return False
+
+        pipe = self.redis.pipeline()
+        for i in TRAINING_LABELS:
+            pipe.hdel(training_key(i), entry_id)
+        if row is not None:
+            pipe.hset(training_key(label), entry_id, row)
+        pipe.incr(training_key('generation'))
+        pipe.execute()
+        return True
+
+    def matrix(self, label):
+        rows = self.redis.hvals(training_key(label))
+        return np.frombuffer(b''.join(rows), dtype=np.float32).reshape(len(rows), len(self.columns))
+
+    # the model trained at a generation, if it's still that generation
+    def trained_version(self, generation):
+        trained = self.redis.hgetall(training_key('trained'))
+        if int(trained.get('generation', -1)) == generation:
+            return trained.get('version')
+        return None
+
+    def set_trained(self, generation, version):
+        self.redis.hmset(training_key('trained'), {'generation': generation, 'version': version})